@@ -3,6 +3,7 @@ import json
 from db import db
 from flask import Flask, request
 from db import Task, Subtask, Category
+from responses import json_response
 
 # define db filename
 db_filename = "todo.db"
@@ -21,11 +22,11 @@ with app.app_context():
 
 # generalized response formats
 def success_response(data, code=200):
-    return json.dumps(data), code
+    return json_response(data, code)
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response({"error": message}, code)
 
 
 # -- TASK ROUTES ------------------------------------------------------
@@ -3,6 +3,9 @@ import json
 from db import db
 from flask import Flask, request
 from db import Course, User, Assignment
+from batch import batch_error, batch_response
+from responses import json_response
+from validation import compile_schema, errors_response, Field
 
 app = Flask(__name__)
 db_filename = "cms.db"
@@ -11,6 +14,11 @@ app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ECHO"] = True
 
+validate_course = compile_schema(Field("code"), Field("name"))
+validate_user = compile_schema(Field("name"), Field("netid", label="Net ID"))
+validate_enrollment = compile_schema(Field("user_id", label="User ID"), Field("type"))
+validate_assignment = compile_schema(Field("title"), Field("due_date"))
+
 db.init_app(app)
 with app.app_context():
     # db.drop_all()
@@ -19,11 +27,11 @@ with app.app_context():
 
 # generalized response formats
 def success_response(data, code=200):
-    return json.dumps(data), code
+    return json_response(data, code)
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response({"error": message}, code)
 
 
 # your routes here
@@ -42,13 +50,9 @@ def create_course():
     """
     Endpoint for creating a new course
     """
-    body = json.loads(request.data)
-    code = body.get("code")
-    if code is None:
-        return failure_response("Code required", 400)
-    name = body.get("name")
-    if name is None:
-        return failure_response("Name required", 400)
+    (code, name), errors = validate_course(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
     new_course = Course(code=code, name=name)
     db.session.add(new_course)
     db.session.commit()
@@ -84,13 +88,9 @@ def create_user():
     """
     Endpoint for creating a new user
     """
-    body = json.loads(request.data)
-    name = body.get("name")
-    if name is None:
-        return failure_response("Name required", 400)
-    netid = body.get("netid")
-    if netid is None:
-        return failure_response("Net ID required", 400)
+    (name, netid), errors = validate_user(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
     new_user = User(name=name, netid=netid)
     db.session.add(new_user)
     db.session.commit()
@@ -116,13 +116,9 @@ def add_user_to_course(course_id):
     course = Course.query.filter_by(id=course_id).first()
     if course is None:
         return failure_response("Course not found")
-    body = json.loads(request.data)
-    user_id = body.get("user_id")
-    if user_id is None:
-        return failure_response("User ID required", 400)
-    type = body.get("type")
-    if type is None:
-        return failure_response("Type required", 400)
+    (user_id, type), errors = validate_enrollment(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found")
@@ -146,18 +142,28 @@ def create_assignment_for_course(course_id):
     course = Course.query.filter_by(id=course_id).first()
     if course is None:
         return failure_response("Course not found", 400)
-    body = json.loads(request.data)
-    title = body.get("title")
-    if title is None:
-        return failure_response("Title required", 400)
-    due_date = body.get("due_date")
-    if due_date is None:
-        return failure_response("Due date required", 400)
+    (title, due_date), errors = validate_assignment(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
     new_assignment = Assignment(title=title, due_date=due_date, course_id=course_id)
     db.session.add(new_assignment)
     db.session.commit()
     return success_response(new_assignment.serialize())
 
 
+@app.route("/api/batch/", methods=["POST"])
+def batch():
+    """
+    Endpoint for running several requests at once. Set ?parallel=true to
+    run consecutive GET requests in parallel.
+    """
+    subrequests = json.loads(request.data)
+    error = batch_error(subrequests)
+    if error is not None:
+        return failure_response(error, 400)
+    parallel = request.args.get("parallel", "").lower() in ("1", "true")
+    return batch_response(app, request.path, subrequests, parallel)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
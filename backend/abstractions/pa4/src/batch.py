@@ -0,0 +1,115 @@
+"""
+Batched requests.
+
+A batch is a JSON array of sub-requests, each an object with a method, a
+path and an optional JSON body. Every sub-request is dispatched to its view
+through the app's URL map in this process, so the client makes one round
+trip for all of them. The results keep the order of the sub-requests.
+
+With parallel set, each run of consecutive GET sub-requests is spread over
+a small thread pool. Other methods run alone, after every sub-request
+before them has finished, so they still see the effects of earlier writes.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from flask import Response
+from werkzeug.exceptions import HTTPException
+
+from responses import dumps
+from responses import JSON_MIMETYPE
+from validation import compile_schema
+from validation import Field
+
+# Most sub-requests a batch can hold
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 50))
+
+# Threads that run GET sub-requests of parallel batches
+BATCH_THREADS = int(os.environ.get("BATCH_THREADS", 4))
+
+READS = ThreadPoolExecutor(BATCH_THREADS, thread_name_prefix="batch")
+
+validate_subrequest = compile_schema(
+    Field("method", str), Field("path", str), Field("body", required=False)
+)
+
+
+def result(status, body):
+    """
+    Returns the encoded result of a sub-request, where body is already
+    encoded as JSON
+    """
+    return b'{"status":%d,"body":%s}' % (status, body)
+
+
+def run_subrequest(app, batch_path, subrequest):
+    """
+    Dispatches one sub-request to its view and returns its encoded result
+    """
+    (method, path, body), errors = validate_subrequest(subrequest)
+    if errors:
+        return result(400, dumps({"error": errors[0], "errors": errors}))
+    if path.split("?", 1)[0] == batch_path:
+        return result(400, dumps({"error": "Batch requests cannot be nested"}))
+    data = None if body is None else dumps(body)
+    with app.test_request_context(path, method=method.upper(), data=data):
+        try:
+            response = app.make_response(app.dispatch_request())
+        except HTTPException as e:
+            return result(e.code, dumps({"error": e.name}))
+        except Exception:
+            app.logger.exception("Batch sub-request failed: %s %s", method, path)
+            return result(500, dumps({"error": "Internal server error"}))
+    data = response.get_data()
+    if response.mimetype != JSON_MIMETYPE:
+        data = dumps(data.decode(response.charset))
+    return result(response.status_code, data)
+
+
+def is_read(subrequest):
+    """
+    Returns whether subrequest is a GET, which can run alongside other GETs
+    """
+    if not isinstance(subrequest, dict):
+        return False
+    method = subrequest.get("method")
+    return isinstance(method, str) and method.upper() == "GET"
+
+
+def batch_response(app, batch_path, subrequests, parallel=False):
+    """
+    Runs subrequests on app and returns a response with their results in
+    order. Sub-requests to batch_path are refused.
+    """
+    results = []
+    i = 0
+    while i < len(subrequests):
+        j = i + 1
+        if parallel and is_read(subrequests[i]):
+            while j < len(subrequests) and is_read(subrequests[j]):
+                j += 1
+        if j - i > 1:
+            results.extend(
+                READS.map(
+                    lambda subrequest: run_subrequest(app, batch_path, subrequest),
+                    subrequests[i:j],
+                )
+            )
+        else:
+            results.append(run_subrequest(app, batch_path, subrequests[i]))
+        i = j
+    body = b'{"results":[' + b",".join(results) + b"]}"
+    return Response(body, mimetype=JSON_MIMETYPE)
+
+
+def batch_error(subrequests):
+    """
+    Returns the error message for a batch that is not a list of at most
+    MAX_BATCH_SIZE sub-requests, or None if it is valid
+    """
+    if not isinstance(subrequests, list):
+        return "Batch must be a JSON array"
+    if len(subrequests) > MAX_BATCH_SIZE:
+        return "Batch can have at most %d requests" % MAX_BATCH_SIZE
+    return None
+
@@ -1,6 +1,8 @@
 import json
 from flask import Flask, request
 import db
+from pool import PoolTimeout
+from responses import json_response
 
 DB = db.DatabaseDriver()
 
@@ -8,11 +10,27 @@ app = Flask(__name__)
 
 
 def success_response(body, code=200):
-    return json.dumps(body), code
+    return json_response(body, code)
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response({"error": message}, code)
+
+
+@app.teardown_appcontext
+def release_connection(exception):
+    """
+    Returns the request thread's database connection to the pool
+    """
+    DB.release()
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    """
+    Responds 503 when no database connection was free in time
+    """
+    return failure_response("Database busy, try again", 503)
 
 
 @app.route("/")
@@ -1,6 +1,7 @@
 import os
 import json
-import sqlite3
+
+from pool import ConnectionPool
 
 
 # From: https://goo.gl/YzypOI
@@ -22,8 +23,22 @@ class DatabaseDriver(object):
     """
 
     def __init__(self):
-        self.conn = sqlite3.connect("todo.db", check_same_thread=False)
+        self.pool = ConnectionPool("todo.db")
         self.create_task_table()
+        self.release()
+
+    @property
+    def conn(self):
+        """
+        The connection of the current thread
+        """
+        return self.pool.connection()
+
+    def release(self):
+        """
+        Returns the current thread's connection to the pool
+        """
+        self.pool.release()
 
     def create_task_table(self):
         try:
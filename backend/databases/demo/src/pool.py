@@ -0,0 +1,119 @@
+"""
+A pool of SQLite connections.
+
+Each thread checks out a connection of its own the first time it needs one
+and keeps it until it releases it, which the app does at the end of every
+request. Threads never share a connection, so their queries are not
+serialized behind one connection's lock. At most size connections are
+open at once; a thread that finds them all checked out waits up to
+timeout seconds for one to be released.
+"""
+import os
+import queue
+import sqlite3
+import threading
+
+# Most connections a pool keeps open
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection is released within the checkout timeout
+    """
+
+
+class ConnectionPool(object):
+    """
+    Pool of connections to one SQLite database file
+    """
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT, setup=None):
+        """
+        Initializes an empty pool of up to size connections to the database
+        at path. setup, if given, is called with each new connection.
+        """
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.setup = setup
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def open(self):
+        """
+        Opens a new connection. Connections move between threads as they
+        are checked out, so sqlite3's same-thread check is off.
+        """
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        if self.setup is not None:
+            self.setup(conn)
+        return conn
+
+    def checkout(self):
+        """
+        Returns an idle connection, opening one if the pool is not full and
+        otherwise waiting for one to be released
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self.open()
+            except Exception:
+                with self.lock:
+                    self.opened -= 1
+                raise
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(
+                "No database connection was free within %g seconds" % self.timeout
+            )
+
+    def connection(self):
+        """
+        Returns the connection of the current thread, checking one out if
+        it has none
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.checkout()
+        return conn
+
+    def release(self):
+        """
+        Returns the current thread's connection, if any, to the pool. A
+        transaction it left open is rolled back.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+        self.local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    def close(self):
+        """
+        Closes the idle connections
+        """
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self.lock:
+                self.opened -= 1
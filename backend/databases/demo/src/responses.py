@@ -0,0 +1,56 @@
+"""
+JSON responses encoded straight to bytes.
+
+The encoder is chosen once at import time. Set JSON_ENCODER to "orjson" or
+"json" to pick one; by default orjson is used when it is installed, and
+the standard library otherwise. Either way responses are UTF-8 bytes
+served as application/json, so Flask does not encode them again.
+"""
+import json
+import os
+
+from flask import Response
+
+JSON_MIMETYPE = "application/json"
+
+
+def stdlib_dumps(data):
+    """
+    Returns data encoded as compact UTF-8 JSON bytes with the standard
+    library encoder
+    """
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def load_encoder(name):
+    """
+    Returns the dumps function of the encoder, name, or of the fastest
+    installed encoder if name is None
+    """
+    if name == "json":
+        return stdlib_dumps
+    try:
+        import orjson
+    except ImportError:
+        if name == "orjson":
+            raise
+        return stdlib_dumps
+    options = orjson.OPT_NON_STR_KEYS
+
+    def orjson_dumps(data):
+        """
+        Returns data encoded as compact UTF-8 JSON bytes with orjson
+        """
+        return orjson.dumps(data, option=options)
+
+    return orjson_dumps
+
+
+dumps = load_encoder(os.environ.get("JSON_ENCODER"))
+
+
+def json_response(data, code=200):
+    """
+    Returns a response with data encoded as JSON and the status, code
+    """
+    return Response(dumps(data), status=code, mimetype=JSON_MIMETYPE)
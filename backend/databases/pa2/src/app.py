@@ -1,18 +1,63 @@
+import codecs
+import csv
 import json
+import os
 from flask import Flask, request
 import db
+from pool import PoolTimeout
+from responses import json_array_chunks
+from responses import json_response
+from responses import json_stream_response
+from validation import compile_schema
+from validation import errors_response
+from validation import Field
 
 DB = db.DatabaseDriver()
 
 app = Flask(__name__)
 
+validate_user = compile_schema(
+    Field("name"), Field("username"), Field("balance", required=False, default=0)
+)
+validate_send = compile_schema(
+    Field("sender_id", label="Sender ID"),
+    Field("receiver_id", label="Receiver ID"),
+    Field("amount"),
+)
+
+# Number of imported users inserted per transaction
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 5000))
+
+# Most invalid rows an import reports one by one
+MAX_IMPORT_ERRORS = 100
+
+# Range of the balances SQLite can store
+MIN_BALANCE = -(2**63)
+MAX_BALANCE = 2**63 - 1
+
 
 def success_response(body, code=200):
-    return json.dumps(body), code
+    return json_response(body, code)
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response({"error": message}, code)
+
+
+@app.teardown_appcontext
+def release_connection(exception):
+    """
+    Returns the request thread's database connection to the pool
+    """
+    DB.release()
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    """
+    Responds 503 when no database connection was free in time
+    """
+    return failure_response("Database busy, try again", 503)
 
 
 @app.route("/")
@@ -21,12 +66,34 @@ def hello_world():
 
 
 # your routes here
+def count_arg(name):
+    """
+    Returns the query param, name, as a non-negative int, or None if it is
+    absent. Raises ValueError if it is not a non-negative int.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError("%s must be a non-negative integer" % name)
+    return int(value)
+
+
 @app.route("/api/users/")
 def get_users():
     """
-    Endpoint for getting all users
+    Endpoint for getting all users, streamed as they are read. ?limit= and
+    ?offset= page through them in id order, and ?after_id= starts after the
+    user with that id.
     """
-    return success_response(DB.get_all_users())
+    try:
+        limit = count_arg("limit")
+        offset = count_arg("offset") or 0
+        after_id = count_arg("after_id")
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    users = DB.iter_users(limit, offset, after_id)
+    return json_stream_response(json_array_chunks(users))
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -34,16 +101,9 @@ def create_user():
     """
     Endpoint for creating a new user
     """
-    body = json.loads(request.data)
-    name = body.get("name")
-    if name is None:
-        return failure_response("Name required")
-    username = body.get("username")
-    if username is None:
-        return failure_response("Username required")
-    balance = body.get("balance")
-    if balance is None:
-        balance = 0
+    (name, username, balance), errors = validate_user(json.loads(request.data))
+    if errors:
+        return errors_response(errors, 404)
     user_id = DB.insert_user_table(name, username, balance)
     user = DB.get_user_by_id(user_id)
     if user is None:
@@ -51,6 +111,130 @@ def create_user():
     return success_response(user, 201)
 
 
+def ndjson_items(stream):
+    """
+    Yields the JSON value on each non-blank line of stream, or None for
+    lines that are not valid JSON. A leading UTF-8 byte order mark is
+    skipped.
+    """
+    for number, line in enumerate(stream):
+        if number == 0:
+            line = line.removeprefix(codecs.BOM_UTF8)
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def csv_items(stream):
+    """
+    Yields a dict for each row of a CSV stream, keyed by the column names in
+    its header row. Empty cells are left out. A leading UTF-8 byte order
+    mark is skipped. Raises UnicodeDecodeError if the stream is not UTF-8,
+    and csv.Error if it is not valid CSV.
+    """
+    lines = codecs.iterdecode(stream, "utf-8-sig")
+    for row in csv.DictReader(lines):
+        yield {name: value for name, value in row.items() if value}
+
+
+def chunked(items, size):
+    """
+    Yields lists of up to size consecutive items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def user_fields(item):
+    """
+    Returns ((name, username, balance), None) for an imported user, or
+    (None, error) if it is not valid
+    """
+    if not isinstance(item, dict):
+        return None, "User must be a JSON object"
+    name = item.get("name")
+    if name is None:
+        return None, "Name required"
+    if not isinstance(name, str):
+        return None, "Name must be a string"
+    username = item.get("username")
+    if username is None:
+        return None, "Username required"
+    if not isinstance(username, str):
+        return None, "Username must be a string"
+    balance = item.get("balance", 0)
+    if isinstance(balance, str):
+        try:
+            balance = int(balance)
+        except ValueError:
+            pass
+    if (
+        not isinstance(balance, int)
+        or isinstance(balance, bool)
+        or not MIN_BALANCE <= balance <= MAX_BALANCE
+    ):
+        return None, "Balance must be an integer"
+    return (name, username, balance), None
+
+
+@app.route("/api/users/import/", methods=["POST"])
+def import_users():
+    """
+    Endpoint for creating users in bulk from an NDJSON body, or a CSV body
+    with Content-Type text/csv. The body is parsed as it streams in and
+    inserted IMPORT_CHUNK_SIZE users per transaction, so memory use does not
+    grow with its size.
+
+    A body that is not UTF-8, or not valid CSV, stops the import with a 400.
+    The users of earlier chunks stay imported and are reported with it.
+    """
+    if request.mimetype == "text/csv":
+        items = csv_items(request.stream)
+    else:
+        items = ndjson_items(request.stream)
+    imported = 0
+    ids = []
+    invalid = 0
+    errors = []
+    failure = None
+    try:
+        for chunk in chunked(enumerate(items, 1), IMPORT_CHUNK_SIZE):
+            users = []
+            for row, item in chunk:
+                fields, error = user_fields(item)
+                if error is None:
+                    users.append(fields)
+                    continue
+                invalid += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({"row": row, "error": error})
+            if not users:
+                continue
+            first, last = DB.insert_users(users)
+            imported += len(users)
+            if ids and ids[-1][1] == first - 1:
+                ids[-1][1] = last
+            else:
+                ids.append([first, last])
+    except UnicodeDecodeError:
+        failure = "Body must be UTF-8"
+    except csv.Error as e:
+        failure = "Invalid CSV: %s" % e
+    body = {"imported": imported, "ids": ids, "invalid": invalid, "errors": errors}
+    if failure is not None:
+        return json_response(dict(error=failure, **body), 400)
+    return success_response(body, 201)
+
+
 @app.route("/api/user/<int:user_id>/")
 def get_user(user_id):
     """
@@ -79,16 +263,9 @@ def send_money():
     """
     Endpoint for sending money from one user to another
     """
-    body = json.loads(request.data)
-    sender_id = body.get("sender_id")
-    if sender_id is None:
-        return failure_response("Sender ID required")
-    receiver_id = body.get("receiver_id")
-    if receiver_id is None:
-        return failure_response("Receiver ID required")
-    amount = body.get("amount")
-    if amount is None:
-        return failure_response("Amount required")
+    (sender_id, receiver_id, amount), errors = validate_send(json.loads(request.data))
+    if errors:
+        return errors_response(errors, 404)
     sender = DB.get_user_by_id(sender_id)
     if sender is None:
         return failure_response("Sender not found")
@@ -97,7 +274,8 @@ def send_money():
         return failure_response("Receiver not found")
     if amount > sender["balance"]:
         return failure_response("Cannot send amount greater than balance", 400)
-    DB.send_money_by_id(sender_id, receiver_id, amount)
+    if not DB.send_money_by_id(sender_id, receiver_id, amount):
+        return failure_response("Cannot send amount greater than balance", 400)
     return success_response(
         {"sender_id": sender_id, "receiver_id": receiver_id, "amount": amount}
     )
@@ -0,0 +1,335 @@
+"""
+Benchmarks for the pa2 database driver and responses.
+
+Usage: python bench.py <name> [<name> ...]
+Run with no arguments to list the available benchmarks.
+"""
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from db import DatabaseDriver
+from db import transfer
+from group_commit import GroupCommitWriter
+from pool import ConnectionPool
+from profiles import apply_profile
+from profiles import PROFILES
+import responses
+
+
+def timed(fn, repeat=5):
+    """
+    Returns the best wall-clock time of fn over repeat runs, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_json():
+    """
+    Time to encode a list of 100k users to response bytes: json.dumps to a
+    str that Flask then encodes, vs each encoder in responses
+    """
+    users = [
+        {"id": i, "name": "User %d" % i, "username": "user%d" % i, "balance": i * 7}
+        for i in range(100_000)
+    ]
+    encoders = {"json.dumps + encode": lambda data: json.dumps(data).encode()}
+    encoders["stdlib"] = responses.load_encoder("json")
+    try:
+        encoders["orjson"] = responses.load_encoder("orjson")
+    except ImportError:
+        print("orjson is not installed")
+    for name, dumps in encoders.items():
+        size = len(dumps(users))
+        seconds = timed(lambda: dumps(users))
+        print(
+            "%-20s %8.1f ms %8.1f MB/s %10d bytes"
+            % (name, seconds * 1000, size / seconds / 1e6, size)
+        )
+
+
+def make_users_db(path, n_users):
+    """
+    Creates a database at path with a user table of n_users rows
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE user (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "name TEXT NOT NULL, username TEXT NOT NULL, balance INTEGER NOT NULL)"
+    )
+    conn.executemany(
+        "INSERT INTO user (name, username, balance) VALUES (?, ?, ?)",
+        (("User %d" % i, "user%d" % i, i) for i in range(n_users)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def throughput(n_threads, operate, n_ops=20_000):
+    """
+    Returns the operations per second of n_threads threads calling
+    operate(i) n_ops times between them
+    """
+    per_thread = n_ops // n_threads
+
+    def work(offset):
+        for i in range(offset, offset + per_thread):
+            operate(i)
+
+    threads = [
+        threading.Thread(target=work, args=(t * per_thread,)) for t in range(n_threads)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_thread * n_threads / (time.perf_counter() - start)
+
+
+def bench_pool():
+    """
+    Lookups by id per second from 1 to 16 threads, all sharing one
+    connection vs each checking a connection out of the pool per lookup,
+    as requests do
+    """
+    n_users = 100_000
+    query = "SELECT id, name, username, balance FROM user WHERE id = ?"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "todo.db")
+        make_users_db(path, n_users)
+        shared = sqlite3.connect(path, check_same_thread=False)
+        pool = ConnectionPool(path)
+
+        def shared_read(i):
+            shared.execute(query, (i % n_users + 1,)).fetchone()
+
+        def pooled_read(i):
+            pool.connection().execute(query, (i % n_users + 1,)).fetchone()
+            pool.release()
+
+        print("threads   shared reads/s   pooled reads/s")
+        for n_threads in (1, 2, 4, 8, 16):
+            print(
+                "%7d %16.0f %16.0f"
+                % (
+                    n_threads,
+                    throughput(n_threads, shared_read),
+                    throughput(n_threads, pooled_read),
+                )
+            )
+        print("connections opened: %d of %d" % (pool.opened, pool.size))
+        shared.close()
+        pool.close()
+
+
+def bench_profiles():
+    """
+    Operations per second of SQLite's defaults and of each tuning profile
+    on a mixed load of 4 threads doing 90% lookups by id and 10% inserts,
+    each in its own commit as in the driver
+    """
+    n_users = 100_000
+    n_threads = 4
+    n_ops = 4_000
+    for name in ["defaults"] + list(PROFILES):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "todo.db")
+            make_users_db(path, n_users)
+            setup = None
+            if name in PROFILES:
+                setup = lambda conn, name=name: apply_profile(conn, name)
+            pool = ConnectionPool(path, setup=setup)
+
+            def operate(i):
+                conn = pool.connection()
+                if i % 10 == 0:
+                    conn.execute(
+                        "INSERT INTO user (name, username, balance) VALUES (?, ?, ?)",
+                        ("User", "user", 0),
+                    )
+                    conn.commit()
+                else:
+                    conn.execute(
+                        "SELECT * FROM user WHERE id = ?", (i * 7919 % n_users + 1,)
+                    ).fetchone()
+                pool.release()
+
+            ops = throughput(n_threads, operate, n_ops)
+            pool.close()
+        print("%-10s %10.0f ops/s" % (name, ops))
+
+
+def bench_group_commit():
+    """
+    Transfers per second from 16 threads under the durable profile, each
+    committing its own transfer vs handing it to a group commit writer
+    """
+    n_users = 1000
+    n_threads = 16
+    n_transfers = 4_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "todo.db")
+        make_users_db(path, n_users)
+        pool = ConnectionPool(path, size=n_threads, setup=apply_profile)
+        writer = GroupCommitWriter(pool, transfer)
+
+        def direct(i):
+            conn = pool.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            transfer(conn, i % n_users + 1, (i + 1) % n_users + 1, 1)
+            conn.commit()
+            pool.release()
+
+        def grouped(i):
+            writer.submit(i % n_users + 1, (i + 1) % n_users + 1, 1)
+
+        print("direct  %8.0f transfers/s" % throughput(n_threads, direct, n_transfers))
+        print("grouped %8.0f transfers/s" % throughput(n_threads, grouped, n_transfers))
+        print("mean batch %.1f transfers" % (writer.writes / writer.batches))
+        conn = sqlite3.connect(path)
+        total = conn.execute("SELECT SUM(balance) FROM user").fetchone()[0]
+        assert total == sum(range(n_users))
+        conn.close()
+
+
+def write_ndjson_users(path, n_users):
+    """
+    Writes n_users users to an NDJSON file at path and returns its size
+    """
+    with open(path, "w") as f:
+        for i in range(n_users):
+            f.write('{"name":"User %d","username":"user%d","balance":%d}\n' % (i, i, i))
+        return f.tell()
+
+
+def load_app(directory):
+    """
+    Imports the app with its database in directory and returns it
+    """
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import app
+    finally:
+        os.chdir(cwd)
+    return app.app
+
+
+def bench_import():
+    """
+    Users created per second by one POST /api/users/ each vs a streamed
+    POST /api/users/import/, and the import's peak traced memory as the
+    upload grows
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        client = load_app(tmp).test_client()
+
+        def create_one_by_one():
+            for i in range(2000):
+                client.post(
+                    "/api/users/",
+                    data=json.dumps({"name": "User", "username": "user%d" % i}),
+                )
+
+        seconds = timed(create_one_by_one, repeat=1)
+        print("one by one %10.0f users/s" % (2000 / seconds))
+
+        def import_users(n_users, trace=False):
+            path = os.path.join(tmp, "users.ndjson")
+            size = write_ndjson_users(path, n_users)
+            with open(path, "rb") as f:
+                if trace:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                response = client.post(
+                    "/api/users/import/",
+                    input_stream=f,
+                    content_length=size,
+                    content_type="application/x-ndjson",
+                )
+                seconds = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] if trace else 0
+                tracemalloc.stop()
+            assert json.loads(response.data)["imported"] == n_users
+            return seconds, peak
+
+        seconds, _ = import_users(500_000)
+        print("import     %10.0f users/s (500k users)" % (500_000 / seconds))
+        for n_users in (50_000, 200_000):
+            _, peak = import_users(n_users, trace=True)
+            print("import of %dk users: peak %.1f MB" % (n_users // 1000, peak / 1e6))
+
+
+def bench_list_users():
+    """
+    Peak traced memory and time of GET /api/users/ as the user table grows,
+    streamed vs building the whole list and encoding it at once as before
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        app = load_app(tmp)
+        client = app.test_client()
+        total = 0
+        for n_users in (50_000, 200_000, 400_000):
+            path = os.path.join(tmp, "users.ndjson")
+            size = write_ndjson_users(path, n_users - total)
+            with open(path, "rb") as f:
+                client.post(
+                    "/api/users/import/",
+                    input_stream=f,
+                    content_length=size,
+                    content_type="application/x-ndjson",
+                )
+            total = n_users
+
+            def listed():
+                driver = DatabaseDriver()
+                cursor = driver.conn.execute("SELECT id, name, username FROM user;")
+                users = [{"id": r[0], "name": r[1], "username": r[2]} for r in cursor]
+                driver.release()
+                return len(json.dumps(users))
+
+            def streamed():
+                response = client.get("/api/users/", buffered=False)
+                size = sum(len(chunk) for chunk in response.response)
+                response.close()
+                return size
+
+            for name, fn in (("list", listed), ("stream", streamed)):
+                seconds = timed(fn, repeat=1)
+                tracemalloc.start()
+                fn()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(
+                    "%3dk users %-7s %8.1f ms  peak %7.1f MB"
+                    % (n_users // 1000, name, seconds * 1000, peak / 1e6)
+                )
+
+
+BENCHMARKS = {
+    "json": bench_json,
+    "pool": bench_pool,
+    "profiles": bench_profiles,
+    "group-commit": bench_group_commit,
+    "import": bench_import,
+    "list-users": bench_list_users,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    if not names:
+        print("Available benchmarks: " + ", ".join(BENCHMARKS))
+    for name in names:
+        BENCHMARKS[name]()
@@ -1,5 +1,14 @@
 import os
-import sqlite3
+
+from group_commit import GroupCommitWriter
+from pool import ConnectionPool
+from profiles import apply_profile
+
+# Set GROUP_COMMIT to 1 to commit concurrent transfers together
+GROUP_COMMIT = os.environ.get("GROUP_COMMIT", "").lower() in ("1", "true")
+
+# Rows fetched from a cursor at a time when streaming
+FETCH_SIZE = 1000
 
 
 # From: https://goo.gl/YzypOI
@@ -22,11 +31,34 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secures a connection with the database and stores it into the
-        instance variable `conn`
+        Sets up a pool of connections to the database, which threads reach
+        through `conn`
         """
-        self.conn = sqlite3.connect("todo.db", check_same_thread=False)
+        self.pool = ConnectionPool("todo.db", setup=self.setup_connection)
         self.create_user_table()
+        self.release()
+        self.writer = None
+        if GROUP_COMMIT:
+            self.writer = GroupCommitWriter(self.pool, transfer)
+
+    def setup_connection(self, conn):
+        """
+        Prepares a new connection from the pool
+        """
+        apply_profile(conn)
+
+    @property
+    def conn(self):
+        """
+        The connection of the current thread
+        """
+        return self.pool.connection()
+
+    def release(self):
+        """
+        Returns the current thread's connection to the pool
+        """
+        self.pool.release()
 
     def create_user_table(self):
         """
@@ -50,13 +82,27 @@ class DatabaseDriver(object):
         """
         Using SQL, gets all users from the user table
         """
-        cursor = self.conn.execute("SELECT id, name, username FROM user;")
-        tasks = []
-
-        for row in cursor:
-            tasks.append({"id": row[0], "name": row[1], "username": row[2]})
+        return list(self.iter_users())
 
-        return tasks
+    def iter_users(self, limit=None, offset=0, after_id=None):
+        """
+        Using SQL, returns an iterator over up to limit users in id order,
+        skipping the first offset of them and, if after_id is given, those
+        with ids up to it. The connection is checked out and the query run
+        right away, so a busy pool fails here rather than mid-iteration;
+        rows are then fetched FETCH_SIZE at a time, so only one batch is
+        held in memory.
+        """
+        query = "SELECT id, name, username FROM user"
+        params = []
+        if after_id is not None:
+            query += " WHERE id > ?"
+            params.append(after_id)
+        query += " ORDER BY id LIMIT ? OFFSET ?;"
+        params += [-1 if limit is None else limit, offset]
+        cursor = self.conn.execute(query, params)
+        cursor.row_factory = user_row
+        return fetch_rows(cursor)
 
     def insert_user_table(self, name, username, balance):
         """
@@ -71,6 +117,26 @@ class DatabaseDriver(object):
         self.conn.commit()
         return cursor.lastrowid
 
+    def insert_users(self, users):
+        """
+        Using SQL, adds users, a list of (name, username, balance) tuples, to
+        the user table in one transaction. Their ids are consecutive;
+        returns the first and the last.
+        """
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO user (name, username, balance) VALUES (?, ?, ?);", users
+            )
+            cursor = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'user'")
+            last = cursor.fetchone()[0]
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        return last - len(users) + 1, last
+
     def get_user_by_id(self, id):
         """
         Using SQL, gets a user by id
@@ -97,35 +163,68 @@ class DatabaseDriver(object):
 
     def send_money_by_id(self, sender_id, receiver_id, amount):
         """
-        Using SQL, sends money from one user to another by id
+        Using SQL, sends money from one user to another by id, in one
+        transaction. Returns False without sending anything if the sender
+        has less than amount.
         """
-        cursor = self.conn.execute("SELECT * FROM user WHERE id = ?", (sender_id,))
+        if self.writer is not None:
+            return self.writer.submit(sender_id, receiver_id, amount)
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            sent = transfer(conn, sender_id, receiver_id, amount)
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        return sent
 
-        for row in cursor:
-            new_balance = row[3] - amount
-            self.conn.execute(
-                """
-                UPDATE user
-                SET balance = ?
-                WHERE id = ?;
-            """,
-                (new_balance, sender_id),
-            )
-            self.conn.commit()
 
-        cursor = self.conn.execute("SELECT * FROM user WHERE id = ?", (receiver_id,))
+def transfer(conn, sender_id, receiver_id, amount):
+    """
+    Using SQL, moves amount from the sender's balance to the receiver's
+    within the current transaction of conn. Returns False without changing
+    anything if the sender has less than amount.
+    """
+    cursor = conn.execute("SELECT balance FROM user WHERE id = ?", (sender_id,))
+    row = cursor.fetchone()
+    if row is None or row[0] < amount:
+        return False
+    conn.execute(
+        """
+        UPDATE user
+        SET balance = balance - ?
+        WHERE id = ?;
+    """,
+        (amount, sender_id),
+    )
+    conn.execute(
+        """
+        UPDATE user
+        SET balance = balance + ?
+        WHERE id = ?;
+    """,
+        (amount, receiver_id),
+    )
+    return True
 
-        for row in cursor:
-            new_balance = row[3] + amount
-            self.conn.execute(
-                """
-                UPDATE user
-                SET balance = ?
-                WHERE id = ?;
-            """,
-                (new_balance, receiver_id),
-            )
-            self.conn.commit()
+
+def fetch_rows(cursor):
+    """
+    Yields the rows of cursor, fetching FETCH_SIZE at a time
+    """
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def user_row(cursor, row):
+    """
+    Returns the dict of a row of id, name and username from the user table
+    """
+    return {"id": row[0], "name": row[1], "username": row[2]}
 
 
 # Only <=1 instance of the database driver
@@ -0,0 +1,121 @@
+"""
+Group commit for small write transactions.
+
+Callers hand their writes to a single writer thread, which applies every
+write that is waiting, up to a batch size, in one transaction and commits
+them together, so a burst of writes costs one sync instead of one each.
+Each write runs inside its own savepoint: a write that fails is rolled back
+alone and its caller gets the error, while the rest of the batch commits.
+Callers block until the commit that holds their write has finished.
+
+Batches form on their own: while one commits, the next callers queue up.
+The writer can also wait a little for more writes before committing,
+which only pays off when commits are much slower than the writes.
+"""
+from concurrent.futures import Future
+import os
+import queue
+import threading
+import time
+
+# Most writes committed together
+GROUP_COMMIT_BATCH_SIZE = int(os.environ.get("GROUP_COMMIT_BATCH_SIZE", 64))
+
+# Seconds the writer waits for more writes to fill a batch once no more
+# are queued
+GROUP_COMMIT_MAX_WAIT = float(os.environ.get("GROUP_COMMIT_MAX_WAIT", 0))
+
+
+class GroupCommitWriter(object):
+    """
+    Writer thread that commits the writes of many callers together
+    """
+
+    def __init__(
+        self,
+        pool,
+        apply,
+        batch_size=GROUP_COMMIT_BATCH_SIZE,
+        max_wait=GROUP_COMMIT_MAX_WAIT,
+    ):
+        """
+        Starts a writer on a connection of its own from pool. Each write is
+        a call apply(conn, *args), whose return value is the caller's result.
+        """
+        self.pool = pool
+        self.apply = apply
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.thread = threading.Thread(
+            target=self.run, name="group-commit", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, *args):
+        """
+        Queues the write, apply(conn, *args), and returns its result once
+        it is committed, or raises its error
+        """
+        future = Future()
+        self.queue.put((args, future))
+        return future.result()
+
+    def next_batch(self):
+        """
+        Waits for a write, then returns it with every write that arrives
+        within max_wait, up to batch_size
+        """
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(
+                    self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                )
+            except queue.Empty:
+                break
+        return batch
+
+    def commit(self, conn, batch):
+        """
+        Applies the writes of batch in one transaction and resolves their
+        callers once it has committed
+        """
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for args, future in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, self.apply(conn, *args), None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    results.append((future, None, e))
+                conn.execute("RELEASE write")
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for args, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.writes += len(batch)
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run(self):
+        """
+        Commits batches of writes until the process exits
+        """
+        conn = self.pool.open()
+        # Transactions are managed explicitly, not by sqlite3
+        conn.isolation_level = None
+        while True:
+            self.commit(conn, self.next_batch())
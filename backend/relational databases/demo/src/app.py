@@ -1,6 +1,8 @@
 import json
 from flask import Flask, request
 import db
+from pool import PoolTimeout
+from responses import json_response
 
 DB = db.DatabaseDriver()
 
@@ -9,11 +11,27 @@ app = Flask(__name__)
 
 # generalized response formats
 def success_response(body, code=200):
-    return json.dumps(body), code
+    return json_response(body, code)
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response({"error": message}, code)
+
+
+@app.teardown_appcontext
+def release_connection(exception):
+    """
+    Returns the request thread's database connection to the pool
+    """
+    DB.release()
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    """
+    Responds 503 when no database connection was free in time
+    """
+    return failure_response("Database busy, try again", 503)
 
 
 @app.route("/")
@@ -92,15 +110,15 @@ def create_subtask(task_id):
             "done": False,
             "task_id": task_id,
         }
-        return json.dumps({"success": True, "data": subtask})
+        return json_response({"success": True, "data": subtask})
     except sqlite3.IntegrityError:
-        return json.dumps({"success": False, "error": "Task not found"}), 404
+        return json_response({"success": False, "error": "Task not found"}, 404)
 
 
 @app.route("/task/<int:task_id>/subtasks/")
 def get_subtasks_of_task(task_id):
     res = {"subtasks": DB.get_subtasks_of_task(task_id)}
-    return json.dumps(res), 200
+    return json_response(res, 200)
 
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-import sqlite3
+from pool import ConnectionPool
 
 
 # From: https://goo.gl/YzypOI
@@ -21,13 +21,32 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secures a connection with the database and stores it into the
-        instance variable `conn`
+        Sets up a pool of connections to the database, which threads reach
+        through `conn`
         """
-        self.conn = sqlite3.connect("todo.db", check_same_thread=False)
-        self.conn.execute("PRAGMA foreign_keys = 1")
+        self.pool = ConnectionPool("todo.db", setup=self.setup_connection)
         self.create_task_table()
         self.create_subtask_table()
+        self.release()
+
+    def setup_connection(self, conn):
+        """
+        Prepares a new connection from the pool
+        """
+        conn.execute("PRAGMA foreign_keys = 1")
+
+    @property
+    def conn(self):
+        """
+        The connection of the current thread
+        """
+        return self.pool.connection()
+
+    def release(self):
+        """
+        Returns the current thread's connection to the pool
+        """
+        self.pool.release()
 
     # -- TASKS -----------------------------------------------------------
 
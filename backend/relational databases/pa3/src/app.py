@@ -1,21 +1,59 @@
 from datetime import datetime
+from itertools import chain
 import json
 
+from batch import batch_error
+from batch import batch_response
 import db
 from flask import Flask
 from flask import request
+from pool import PoolTimeout
+from responses import json_array_chunks
+from responses import json_response
+from responses import json_stream_response
+from validation import compile_schema
+from validation import errors_response
+from validation import Field
 
 DB = db.DatabaseDriver()
 
 app = Flask(__name__)
 
+validate_user = compile_schema(
+    Field("name"), Field("username"), Field("balance", required=False, default=0)
+)
+validate_transaction = compile_schema(
+    Field("sender_id", label="Sender ID"),
+    Field("receiver_id", label="Receiver ID"),
+    Field("amount"),
+    Field("message"),
+    Field("accepted", required=False),
+)
+validate_accepted = compile_schema(Field("accepted"))
+
 
 def success_response(body, code=200):
-    return json.dumps(body), code
+    return json_response(body, code)
 
 
 def failure_response(message, code=404):
-    return json.dumps({"error": message}), code
+    return json_response({"error": message}, code)
+
+
+@app.teardown_appcontext
+def release_connection(exception):
+    """
+    Returns the request thread's database connection to the pool
+    """
+    DB.release()
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    """
+    Responds 503 when no database connection was free in time
+    """
+    return failure_response("Database busy, try again", 503)
 
 
 @app.route("/")
@@ -24,12 +62,35 @@ def hello_world():
 
 
 # your routes here
+def count_arg(name):
+    """
+    Returns the query param, name, as a non-negative int, or None if it is
+    absent. Raises ValueError if it is not a non-negative int.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError("%s must be a non-negative integer" % name)
+    return int(value)
+
+
 @app.route("/api/users/")
 def get_users():
     """
-    Endpoint for getting all users
+    Endpoint for getting all users, streamed as they are read. ?limit= and
+    ?offset= page through them in id order, and ?after_id= starts after the
+    user with that id.
     """
-    return success_response({"users: ": DB.get_all_users()})
+    try:
+        limit = count_arg("limit")
+        offset = count_arg("offset") or 0
+        after_id = count_arg("after_id")
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    users = DB.iter_users(limit, offset, after_id)
+    chunks = chain([b'{"users: ":'], json_array_chunks(users), [b"}"])
+    return json_stream_response(chunks)
 
 
 @app.route("/api/users/", methods=["POST"])
@@ -37,16 +98,9 @@ def create_user():
     """
     Endpoint for creating a new user
     """
-    body = json.loads(request.data)
-    name = body.get("name")
-    if name is None:
-        return failure_response("Name required", 400)
-    username = body.get("username")
-    if username is None:
-        return failure_response("Username required", 400)
-    balance = body.get("balance")
-    if balance is None:
-        balance = 0
+    (name, username, balance), errors = validate_user(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
     user_id = DB.insert_user_table(name, username, balance)
     user = DB.get_user_by_id(user_id)
     if user is None:
@@ -84,20 +138,10 @@ def create_transaction():
     """
     Endpoint for creating a new transaction
     """
-    body = json.loads(request.data)
-    sender_id = body.get("sender_id")
-    if sender_id is None:
-        return failure_response("Sender ID required", 400)
-    receiver_id = body.get("receiver_id")
-    if receiver_id is None:
-        return failure_response("Receiver ID required", 400)
-    amount = body.get("amount")
-    if amount is None:
-        return failure_response("Amount required", 400)
-    message = body.get("message")
-    if message is None:
-        return failure_response("Message required", 400)
-    accepted = body.get("accepted")
+    values, errors = validate_transaction(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    sender_id, receiver_id, amount, message, accepted = values
     sender = DB.get_user_by_id(sender_id)
     if sender is None:
         return failure_response("Sender not found")
@@ -122,10 +166,9 @@ def accept_or_deny_request(txn_id):
     """
     Endpoint for accepting or denying a request transaction by id
     """
-    body = json.loads(request.data)
-    new_accepted = body.get("accepted")
-    if new_accepted is None:
-        return failure_response("Accepted required", 400)
+    (new_accepted,), errors = validate_accepted(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
     transaction = DB.get_transaction_by_id(txn_id)
     old_accepted = transaction["accepted"]
     if old_accepted is None:
@@ -146,6 +189,20 @@ def accept_or_deny_request(txn_id):
         return failure_response("Transaction has already been accepted or denied", 403)
 
 
+@app.route("/api/batch/", methods=["POST"])
+def batch():
+    """
+    Endpoint for running several requests at once. Set ?parallel=true to
+    run consecutive GET requests in parallel.
+    """
+    subrequests = json.loads(request.data)
+    error = batch_error(subrequests)
+    if error is not None:
+        return failure_response(error, 400)
+    parallel = request.args.get("parallel", "").lower() in ("1", "true")
+    return batch_response(app, request.path, subrequests, parallel)
+
+
 def send_money(sender_id, receiver_id, amount):
     """
     Helper method for sending money from one user to another by id
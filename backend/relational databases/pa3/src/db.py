@@ -1,4 +1,8 @@
-import sqlite3
+from pool import ConnectionPool
+from profiles import apply_profile
+
+# Rows fetched from a cursor at a time when streaming
+FETCH_SIZE = 1000
 
 
 # From: https://goo.gl/YzypOI
@@ -21,14 +25,33 @@ class DatabaseDriver(object):
 
     def __init__(self):
         """
-        Secures a connection with the database and stores it into the
-        instance variable `conn`
+        Sets up a pool of connections to the database, which threads reach
+        through `conn`
         """
-        self.conn = sqlite3.connect("todo.db", check_same_thread=False)
-        self.conn.execute("PRAGMA foreign_keys = 1")
+        self.pool = ConnectionPool("todo.db", setup=self.setup_connection)
         self.create_user_table()
         self.create_transaction_table()
+        self.release()
+
+    def setup_connection(self, conn):
+        """
+        Prepares a new connection from the pool
+        """
+        conn.execute("PRAGMA foreign_keys = 1")
+        apply_profile(conn)
 
+    @property
+    def conn(self):
+        """
+        The connection of the current thread
+        """
+        return self.pool.connection()
+
+    def release(self):
+        """
+        Returns the current thread's connection to the pool
+        """
+        self.pool.release()
 
     def create_user_table(self):
         """
@@ -52,13 +75,27 @@ class DatabaseDriver(object):
         """
         Using SQL, gets all users from the user table
         """
-        cursor = self.conn.execute("SELECT id, name, username FROM user;")
-        tasks = []
-
-        for row in cursor:
-            tasks.append({"id": row[0], "name": row[1], "username": row[2]})
+        return list(self.iter_users())
 
-        return tasks
+    def iter_users(self, limit=None, offset=0, after_id=None):
+        """
+        Using SQL, returns an iterator over up to limit users in id order,
+        skipping the first offset of them and, if after_id is given, those
+        with ids up to it. The connection is checked out and the query run
+        right away, so a busy pool fails here rather than mid-iteration;
+        rows are then fetched FETCH_SIZE at a time, so only one batch is
+        held in memory.
+        """
+        query = "SELECT id, name, username FROM user"
+        params = []
+        if after_id is not None:
+            query += " WHERE id > ?"
+            params.append(after_id)
+        query += " ORDER BY id LIMIT ? OFFSET ?;"
+        params += [-1 if limit is None else limit, offset]
+        cursor = self.conn.execute(query, params)
+        cursor.row_factory = user_row
+        return fetch_rows(cursor)
 
     def insert_user_table(self, name, username, balance):
         """
@@ -233,6 +270,24 @@ class DatabaseDriver(object):
         self.conn.commit()
 
 
+def fetch_rows(cursor):
+    """
+    Yields the rows of cursor, fetching FETCH_SIZE at a time
+    """
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def user_row(cursor, row):
+    """
+    Returns the dict of a row of id, name and username from the user table
+    """
+    return {"id": row[0], "name": row[1], "username": row[2]}
+
+
 # Only <=1 instance of the database driver
 # exists within the app at all times
 DatabaseDriver = singleton(DatabaseDriver)
@@ -0,0 +1,57 @@
+"""
+SQLite tuning profiles, applied to each connection as it opens.
+
+Set DB_PROFILE to pick one:
+
+durable   WAL journal with a full sync on every commit, so a committed
+          transaction survives power loss. Readers no longer block the
+          writer. This is the default.
+balanced  WAL journal synced at checkpoints only. A power cut can lose the
+          last few commits but never corrupts the database; an app crash
+          loses nothing. Adds a memory-mapped file and a larger cache.
+fast      No syncing at all, for throwaway and test databases. An OS crash
+          or power cut can corrupt the file.
+"""
+import os
+
+PROFILES = {
+    "durable": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+    },
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "mmap_size": 1024 * 1024 * 1024,
+        "cache_size": -256000,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+
+DB_PROFILE = os.environ.get("DB_PROFILE", "durable")
+
+if DB_PROFILE not in PROFILES:
+    raise ValueError(
+        "DB_PROFILE must be one of %s, not %r" % (", ".join(PROFILES), DB_PROFILE)
+    )
+
+
+def apply_profile(conn, name=DB_PROFILE):
+    """
+    Sets the pragmas of the profile, name, on conn
+    """
+    for pragma, value in PROFILES[name].items():
+        conn.execute("PRAGMA %s = %s" % (pragma, value))
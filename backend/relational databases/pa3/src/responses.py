@@ -0,0 +1,87 @@
+"""
+JSON responses encoded straight to bytes.
+
+The encoder is chosen once at import time. Set JSON_ENCODER to "orjson" or
+"json" to pick one; by default orjson is used when it is installed, and
+the standard library otherwise. Either way responses are UTF-8 bytes
+served as application/json, so Flask does not encode them again.
+"""
+import json
+import os
+
+from flask import Response
+from flask import stream_with_context
+
+JSON_MIMETYPE = "application/json"
+
+# Items encoded per chunk of a streamed JSON array
+STREAM_BATCH_SIZE = 500
+
+
+def stdlib_dumps(data):
+    """
+    Returns data encoded as compact UTF-8 JSON bytes with the standard
+    library encoder
+    """
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def load_encoder(name):
+    """
+    Returns the dumps function of the encoder, name, or of the fastest
+    installed encoder if name is None
+    """
+    if name == "json":
+        return stdlib_dumps
+    try:
+        import orjson
+    except ImportError:
+        if name == "orjson":
+            raise
+        return stdlib_dumps
+    options = orjson.OPT_NON_STR_KEYS
+
+    def orjson_dumps(data):
+        """
+        Returns data encoded as compact UTF-8 JSON bytes with orjson
+        """
+        return orjson.dumps(data, option=options)
+
+    return orjson_dumps
+
+
+dumps = load_encoder(os.environ.get("JSON_ENCODER"))
+
+
+def json_response(data, code=200):
+    """
+    Returns a response with data encoded as JSON and the status, code
+    """
+    return Response(dumps(data), status=code, mimetype=JSON_MIMETYPE)
+
+
+def json_array_chunks(items, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yields the JSON array of the iterable, items, as bytes, encoding
+    batch_size items per chunk
+    """
+    yield b"["
+    separator = b""
+    batch = []
+    for item in items:
+        batch.append(dumps(item))
+        if len(batch) == batch_size:
+            yield separator + b",".join(batch)
+            separator = b","
+            batch = []
+    if batch:
+        yield separator + b",".join(batch)
+    yield b"]"
+
+
+def json_stream_response(chunks, code=200):
+    """
+    Returns a response that streams the JSON bytes chunks as they are
+    produced. The request context stays open until the stream ends.
+    """
+    return Response(stream_with_context(chunks), status=code, mimetype=JSON_MIMETYPE)
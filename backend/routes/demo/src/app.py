@@ -1,6 +1,7 @@
 import json
 from flask import Flask
 from flask import request
+from responses import json_response
 
 app = Flask(__name__)
 
@@ -23,7 +24,7 @@ def get_tasks():
     Returns all tasks
     """
     res = {"tasks": list(tasks.values())}
-    return json.dumps(res), 200  # 200 response code: data/tasks retrieved successfully
+    return json_response(res, 200)  # 200 response code: data/tasks retrieved successfully
 
 
 @app.route(
@@ -39,7 +40,7 @@ def create_task():
     task = {"id": task_id_counter, "description": description, "done": False}
     tasks[task_id_counter] = task
     task_id_counter += 1
-    return json.dumps(task), 201  # 201 response code: data/task created successfully
+    return json_response(task, 201)  # 201 response code: data/task created successfully
 
 
 @app.route("/tasks/<int:task_id>")
@@ -49,8 +50,8 @@ def get_task(task_id):
     """
     task = tasks.get(task_id)
     if task is None:
-        return json.dumps({"error": "Task not found"}), 404
-    return json.dumps(task), 200  # 200 response code: data/task retrieved successfully
+        return json_response({"error": "Task not found"}, 404)
+    return json_response(task, 200)  # 200 response code: data/task retrieved successfully
 
 
 @app.route("/tasks/<int:task_id>", methods=["POST"])
@@ -61,10 +62,10 @@ def update_task(task_id):
     body = json.loads(request.data)
     task = tasks.get(task_id)
     if task is None:
-        return json.dumps({"error": "Task not found"}), 404
+        return json_response({"error": "Task not found"}, 404)
     task["description"] = body["description"]
     task["done"] = body["done"]
-    return json.dumps(task), 201
+    return json_response(task, 201)
 
 
 @app.route("/tasks/<int:task_id>", methods=["DELETE"])
@@ -75,11 +76,11 @@ def delete_task(task_id):
     global task_id_counter
     task = tasks.get(task_id)
     if task is None:
-        return json.dumps({"error": "Task not found"}), 404
+        return json_response({"error": "Task not found"}, 404)
     # delete(task_id)
     # task_id_counter -= 1
     del tasks[task_id]
-    return json.dumps(task), 200
+    return json_response(task, 200)
 
 
 # def delete(task_id):
@@ -1,12 +1,32 @@
+import atexit
 import json
+import os
+import zlib
 
 from flask import Flask
 from flask import jsonify
+from flask import make_response
 from flask import request
+from flask import Response
+
+from events import EventBus
+from indexes import hot_score
+from pagination import parse_page_args
+from pagination import render_listing
+from pagination import stream_response
+from persistence import Journal
+from shared import SharedStore
+from store import MAX_UPVOTES
+from store import MIN_UPVOTES
+from store import PostStore
+from store import TOP_COMMENTS
+from validation import compile_schema
+from validation import errors_response
+from validation import Field
 
 app = Flask(__name__)
 
-posts = {
+initial_posts = {
     0: {
         "id": 0,
         "upvotes": 1,
@@ -23,7 +43,7 @@ posts = {
     },
 }
 
-comments_lists = {
+initial_comments_lists = {
     0: {
         0: {
             "id": 0,
@@ -35,9 +55,260 @@ comments_lists = {
     1: {},
 }
 
+def env_flag(name):
+    """
+    Returns whether the environment variable, name, is set to 1 or true
+    """
+    return os.environ.get(name, "").lower() in ("1", "true")
+
+
+# Number of batch items validated and created together
+BATCH_CHUNK_SIZE = 1000
+
+# Set UNIQUE_VOTES to require a username on upvotes, so each user can
+# upvote each post once. Otherwise an upvote without one can only add or
+# take away a single vote.
+UNIQUE_VOTES = env_flag("UNIQUE_VOTES")
+
+# Set REJECT_DUPLICATE_LINKS to refuse new posts whose link was already
+# posted
+REJECT_DUPLICATE_LINKS = env_flag("REJECT_DUPLICATE_LINKS")
+
+validate_post = compile_schema(Field("title"), Field("link"), Field("username"))
+validate_comment = compile_schema(Field("text"), Field("username"))
+validate_comment_edit = compile_schema(Field("text"))
+validate_extra_post = compile_schema(
+    Field("title", str), Field("link", str), Field("username", str)
+)
+validate_extra_comment = compile_schema(Field("text", str), Field("username", str))
+validate_extra_comment_edit = compile_schema(Field("text", str))
+
+# Set SHARED_DB to the path of a database file to share posts and comments
+# between worker processes. Otherwise each process keeps its own in memory.
+shared_db = os.environ.get("SHARED_DB")
+if shared_db is not None:
+    STORE = SharedStore(shared_db)
+    STORE.load(initial_posts, initial_comments_lists)
+else:
+    # Set UPVOTE_STALENESS to a number of seconds to coalesce upvotes
+    upvote_staleness = os.environ.get("UPVOTE_STALENESS")
+    STORE = PostStore(
+        upvote_staleness=None if upvote_staleness is None else float(upvote_staleness)
+    )
+
+    # Set DATA_DIR to persist posts and comments across restarts
+    data_dir = os.environ.get("DATA_DIR")
+    if data_dir is None:
+        STORE.load(initial_posts, initial_comments_lists)
+    else:
+        JOURNAL = Journal(data_dir, fsync=os.environ.get("FSYNC", "batch"))
+        fresh = JOURNAL.is_empty()
+        if fresh:
+            STORE.load(initial_posts, initial_comments_lists)
+        JOURNAL.recover(STORE)
+        if fresh:
+            JOURNAL.snapshot(STORE)
+        JOURNAL.start_snapshots(
+            STORE, float(os.environ.get("SNAPSHOT_INTERVAL", 60))
+        )
+        atexit.register(STORE.close)
+
+EVENTS = EventBus()
+STORE.events = EVENTS
+
+
+def page_args(cursor_type):
+    """
+    Parses the pagination query params of the current request.
+    Returns (limit, cursor, stream, error), where error is a failure
+    response if the params are invalid.
+    """
+    try:
+        limit, cursor, stream = parse_page_args(request.args)
+    except ValueError as e:
+        return None, None, False, (json.dumps({"error": str(e)}), 400)
+    if cursor is not None and not is_cursor_key(cursor, cursor_type):
+        return None, None, False, (json.dumps({"error": "Invalid cursor"}), 400)
+    return limit, cursor, stream, None
 
-pid_counter = 2
-cid_counter = 1
+
+def is_cursor_key(cursor, cursor_type):
+    """
+    Returns whether cursor is an id (cursor_type "id"), an (upvotes, id)
+    rank key (cursor_type "rank"), a (score, id) hot key (cursor_type
+    "hot") or a (pid, cid) comment key (cursor_type "comment")
+    """
+    if cursor_type == "id":
+        return type(cursor) is int
+    if not isinstance(cursor, tuple) or len(cursor) != 2:
+        return False
+    if type(cursor[1]) is not int:
+        return False
+    if cursor_type == "hot":
+        return type(cursor[0]) in (int, float)
+    return type(cursor[0]) is int
+
+
+def serialized_comment(key):
+    """
+    Returns the JSON bytes of the comment for a (pid, cid) comment key, or
+    None if deleted
+    """
+    comment = STORE.get_comments(key[0]) or {}
+    comment = comment.get(key[1])
+    return None if comment is None else comment.to_json()
+
+
+def serialized_post(pid):
+    """
+    Returns the JSON bytes of the post with id, pid, or None if deleted
+    """
+    post = STORE.get_post(pid)
+    return None if post is None else post.to_json()
+
+
+def serialized_post_by_rank(key):
+    """
+    Returns the JSON bytes of the post for an (upvotes, id) rank key or
+    (score, id) hot key, or None if deleted
+    """
+    return serialized_post(key[1])
+
+
+def make_etag(*parts):
+    """
+    Returns an ETag for the given version parts, the process epoch and
+    the current request's query string
+    """
+    query = zlib.crc32(request.query_string)
+    return "-".join([STORE.epoch] + [str(p) for p in parts] + ["%x" % query])
+
+
+def conditional_response(etag, build):
+    """
+    Returns a 304 with no body if the client already has etag, otherwise
+    a 200 with the body returned by build()
+    """
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = make_response(build(), 200)
+    response.set_etag(etag)
+    return response
+
+
+def user_post_keys(username, sort, cursor):
+    """
+    Returns the index keys for the posts created by username, in the order
+    given by sort, starting past cursor
+    """
+    pids = STORE.posts_by(username)
+    if sort in ("increasing", "decreasing", "hot"):
+        posts = [STORE.get_post(pid) for pid in pids]
+        if sort == "hot":
+            keys = [(hot_score(p.upvotes, p.created), p.id) for p in posts if p]
+        else:
+            keys = [(p.upvotes, p.id) for p in posts if p]
+        keys.sort(reverse=sort != "increasing")
+    else:
+        keys = pids
+    if cursor is None:
+        return keys
+    if sort in ("decreasing", "hot"):
+        return [key for key in keys if key < cursor]
+    return [key for key in keys if key > cursor]
+
+
+def link_post_keys(link, username, cursor):
+    """
+    Returns the ids of the posts whose link matches link, optionally only
+    those by username, starting after cursor
+    """
+    keys = STORE.posts_with_link(link)
+    if username is not None:
+        posts = [STORE.get_post(pid) for pid in keys]
+        keys = [p.id for p in posts if p and p.username == username]
+    if cursor is None:
+        return keys
+    return [key for key in keys if key > cursor]
+
+
+def comments_arg():
+    """
+    Parses the comments query param, the number of top comments to embed
+    in each post along with its comment count.
+    Returns (k, error), where k is None if the param is not given and
+    error is a failure response if it is invalid.
+    """
+    k = request.args.get("comments")
+    if k is None:
+        return None, None
+    if not k.isdigit() or int(k) > TOP_COMMENTS:
+        error = "Comments must be between 0 and %d" % TOP_COMMENTS
+        return None, (json.dumps({"error": error}), 400)
+    return int(k), None
+
+
+def with_comments(data, pid, k):
+    """
+    Returns the JSON bytes of a post, data, extended with the comment
+    count and top k comments of the post with id, pid, or None if deleted
+    """
+    summary = STORE.comment_summary(pid, k)
+    if data is None or summary is None:
+        return None
+    count, top = summary
+    return b'%s, "comment_count": %d, "top_comments": [%s]}' % (
+        data[:-1],
+        count,
+        b", ".join(comment.to_json() for comment in top),
+    )
+
+
+def feed_response(key, keys, lookup, limit, stream):
+    """
+    Returns the posts feed for keys. Full feeds are cached per store
+    version under key, and all non-streamed feeds carry an ETag.
+    If the comments param is given, each post also carries its comment
+    count and top comments, and the feed also depends on the comments.
+    """
+    k, error = comments_arg()
+    if error is not None:
+        return error
+    version = STORE.version
+    etag = make_etag("f", version)
+    if k is not None:
+        post_lookup = lookup
+        key += ("comments", k)
+        version = (version, STORE.comment_version)
+        etag = make_etag("f", *version)
+
+        def lookup(key):
+            pid = key if type(key) is int else key[1]
+            return with_comments(post_lookup(key), pid, k)
+
+    if stream:
+        return stream_response(render_listing("posts", keys, lookup, limit))
+
+    def build():
+        if limit is None:
+            return STORE.cached_feed(
+                key,
+                lambda: b"".join(render_listing("posts", keys, lookup)),
+                version,
+            )
+        return b"".join(render_listing("posts", keys, lookup, limit))
+
+    return conditional_response(etag, build)
+
+
+@app.before_request
+def fold_upvotes():
+    """
+    Folds coalesced upvotes into the posts once they exceed the staleness
+    bound, so reads never see counts older than that
+    """
+    STORE.maybe_flush_upvotes()
 
 
 @app.route("/")
@@ -49,10 +320,23 @@ def hello_world():
 @app.route("/api/posts/")
 def get_posts():
     """
-    Returns all posts
+    Returns all posts, optionally only those by username or with the same
+    normalized link, and paginated with limit and cursor
     """
-    res = {"posts": list(posts.values())}
-    return json.dumps(res), 200
+    limit, cursor, stream, error = page_args("id")
+    if error is not None:
+        return error
+    username = request.args.get("username")
+    link = request.args.get("link")
+    if link is not None:
+        keys = link_post_keys(link, username, cursor)
+    elif username is not None:
+        keys = user_post_keys(username, None, cursor)
+    else:
+        keys = STORE.ids(after=cursor)
+    return feed_response(
+        ("ids", username, link), keys, serialized_post, limit, stream
+    )
 
 
 @app.route("/api/posts/", methods=["POST"])
@@ -60,39 +344,37 @@ def create_post():
     """
     Creates a new post
     """
-    global pid_counter
-    body = json.loads(request.data)
-    title = body.get("title")
-    if title is None:
-        return json.dumps({"error": "Title required"}), 400
-    link = body.get("link")
-    if link is None:
-        return json.dumps({"error": "Link required"}), 400
-    username = body.get("username")
-    if username is None:
-        return json.dumps({"error": "Username required"}), 400
-    post = {
-        "id": pid_counter,
-        "upvotes": 1,
-        "title": title,
-        "link": link,
-        "username": username,
-    }
-    posts[pid_counter] = post
-    comments_lists[pid_counter] = {}
-    pid_counter += 1
-    return json.dumps(post), 201
+    (title, link, username), errors = validate_post(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    post = STORE.create_post(
+        title, link, username, unique_link=REJECT_DUPLICATE_LINKS
+    )
+    if post is None:
+        return json.dumps({"error": "Link already posted"}), 409
+    return json.dumps(post.serialize()), 201
 
 
 @app.route("/api/posts/<int:pid>/")
 def get_post(pid):
     """
-    Gets the post with id, pid
+    Gets the post with id, pid, optionally with its comment count and top
+    comments
     """
-    post = posts.get(pid)
+    post = STORE.get_post(pid)
     if post is None:
         return json.dumps({"error": "Post not found"}), 404
-    return json.dumps(post), 200
+    k, error = comments_arg()
+    if error is not None:
+        return error
+    if k is None:
+        etag = make_etag("p", pid, post.version)
+        return conditional_response(etag, post.to_json)
+    etag = make_etag("p", pid, post.version, STORE.comment_version)
+    data = with_comments(post.to_json(), pid, k)
+    if data is None:
+        return json.dumps({"error": "Post not found"}), 404
+    return conditional_response(etag, lambda: data)
 
 
 @app.route("/api/posts/<int:pid>/", methods=["DELETE"])
@@ -100,24 +382,66 @@ def delete_post(pid):
     """
     Deletes the post with id, pid
     """
-    post = posts.get(pid)
+    post = STORE.delete_post(pid)
     if post is None:
         return json.dumps({"error": "Post not found"}), 404
-    del posts[pid]
-    del comments_lists[pid]
-    return json.dumps(post), 200
+    return json.dumps(post.serialize()), 200
 
 
 @app.route("/api/posts/<int:pid>/comments/")
 def get_comments(pid):
     """
-    Returns all comments for the post with id, pid
+    Returns all comments for the post with id, pid, optionally paginated
+    with limit and cursor
     """
-    comments = comments_lists.get(pid)
+    comments = STORE.get_comments(pid)
     if comments is None:
         return json.dumps({"error": "Post not found"}), 404
-    res = {"comments": list(comments.values())}
-    return json.dumps(res), 200
+    limit, cursor, stream, error = page_args("id")
+    if error is not None:
+        return error
+    keys = comments.ids_after(cursor)
+
+    def lookup(cid):
+        comment = comments.get(cid)
+        return None if comment is None else comment.to_json()
+
+    if stream:
+        return stream_response(render_listing("comments", keys, lookup, limit))
+
+    def build():
+        if limit is None:
+            cached = comments.cached
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            data = b"".join(render_listing("comments", keys, lookup))
+            comments.cached = (version, data)
+            return data
+        return b"".join(render_listing("comments", keys, lookup, limit))
+
+    version = comments.version
+    return conditional_response(make_etag("c", pid, version), build)
+
+
+@app.route("/api/comments/")
+def get_user_comments():
+    """
+    Returns all comments by username, optionally paginated with limit and
+    cursor
+    """
+    username = request.args.get("username")
+    if username is None:
+        return json.dumps({"error": "Username required"}), 400
+    limit, cursor, stream, error = page_args("comment")
+    if error is not None:
+        return error
+    keys = STORE.comments_by(username)
+    if cursor is not None:
+        keys = [key for key in keys if key[1] > cursor[1]]
+    chunks = render_listing("comments", keys, serialized_comment, limit)
+    if stream:
+        return stream_response(chunks)
+    return b"".join(chunks), 200
 
 
 @app.route("/api/posts/<int:pid>/comments/", methods=["POST"])
@@ -125,21 +449,13 @@ def post_comment(pid):
     """
     Posts a new comment for the post with id, pid
     """
-    global cid_counter
-    body = json.loads(request.data)
-    text = body.get("text")
-    if text is None:
-        return json.dumps({"error": "Text required"}), 400
-    username = body.get("username")
-    if username is None:
-        return json.dumps({"error": "Username required"}), 400
-    comment = {"id": cid_counter, "upvotes": 1, "text": text, "username": username}
-    comments = comments_lists.get(pid)
-    if comments is None:
+    (text, username), errors = validate_comment(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    comment = STORE.create_comment(pid, text, username)
+    if comment is None:
         return json.dumps({"error": "Post not found"}), 404
-    comments[cid_counter] = comment
-    cid_counter += 1
-    return json.dumps(comment), 201
+    return json.dumps(comment.serialize()), 201
 
 
 @app.route("/api/posts/<int:pid>/comments/<int:cid>/", methods=["POST"])
@@ -147,18 +463,15 @@ def edit_comment(pid, cid):
     """
     Edits the comment with id, cid, for the post with id, pid
     """
-    body = json.loads(request.data)
-    text = body.get("text")
-    if text is None:
-        return json.dumps({"error": "Text required"}), 400
-    comments = comments_lists.get(pid)
+    (text,), errors = validate_comment_edit(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    comments, comment = STORE.edit_comment(pid, cid, text)
     if comments is None:
         return json.dumps({"error": "Post not found"}), 404
-    comment = comments[cid]
     if comment is None:
         return json.dumps({"error": "Comment not found"}), 404
-    comment["text"] = text
-    return json.dumps(comment), 200
+    return json.dumps(comment.serialize()), 200
 
 
 @app.route("/api/extra/posts/", methods=["POST"])
@@ -166,34 +479,15 @@ def extra_create_post():
     """
     Creates a new post
     """
-    global pid_counter
-    body = json.loads(request.data)
-    title = body.get("title")
-    if title is None:
-        return json.dumps({"error": "Title required"}), 400
-    elif not isinstance(title, str):
-        return json.dumps({"error": "Title must be of type <str>"}), 400
-    link = body.get("link")
-    if link is None:
-        return json.dumps({"error": "Link required"}), 400
-    elif not isinstance(link, str):
-        return json.dumps({"error": "Link must be of type <str>"}), 400
-    username = body.get("username")
-    if username is None:
-        return json.dumps({"error": "Username required"}), 400
-    elif not isinstance(username, str):
-        return json.dumps({"error": "Username must be of type <str>"}), 400
-    post = {
-        "id": pid_counter,
-        "upvotes": 1,
-        "title": title,
-        "link": link,
-        "username": username,
-    }
-    posts[pid_counter] = post
-    comments_lists[pid_counter] = {}
-    pid_counter += 1
-    return json.dumps(post), 201
+    (title, link, username), errors = validate_extra_post(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    post = STORE.create_post(
+        title, link, username, unique_link=REJECT_DUPLICATE_LINKS
+    )
+    if post is None:
+        return json.dumps({"error": "Link already posted"}), 409
+    return json.dumps(post.serialize()), 201
 
 
 @app.route("/api/extra/posts/<int:pid>/comments/", methods=["POST"])
@@ -201,25 +495,13 @@ def extra_post_comment(pid):
     """
     Posts a new comment for the post with id, pid
     """
-    global cid_counter
-    body = json.loads(request.data)
-    text = body.get("text")
-    if text is None:
-        return json.dumps({"error": "Text required"}), 400
-    elif not isinstance(text, str):
-        return json.dumps({"error": "Text must be of type <str>"}), 400
-    username = body.get("username")
-    if username is None:
-        return json.dumps({"error": "Username required"}), 400
-    elif not isinstance(username, str):
-        return json.dumps({"error": "Username must be of type <str>"}), 400
-    comment = {"id": cid_counter, "upvotes": 1, "text": text, "username": username}
-    comments = comments_lists.get(pid)
-    if comments is None:
+    (text, username), errors = validate_extra_comment(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    comment = STORE.create_comment(pid, text, username)
+    if comment is None:
         return json.dumps({"error": "Post not found"}), 404
-    comments[cid_counter] = comment
-    cid_counter += 1
-    return json.dumps(comment), 201
+    return json.dumps(comment.serialize()), 201
 
 
 @app.route("/api/extra/posts/<int:pid>/comments/<int:cid>/", methods=["POST"])
@@ -227,59 +509,271 @@ def extra_edit_comment(pid, cid):
     """
     Edits the comment with id, cid, for the post with id, pid
     """
-    body = json.loads(request.data)
-    text = body.get("text")
-    if text is None:
-        return json.dumps({"error": "Text required"}), 400
-    elif not isinstance(text, str):
-        return json.dumps({"error": "Text must be of type <str>"}), 400
-    comments = comments_lists.get(pid)
+    (text,), errors = validate_extra_comment_edit(json.loads(request.data))
+    if errors:
+        return errors_response(errors)
+    comments, comment = STORE.edit_comment(pid, cid, text)
     if comments is None:
         return json.dumps({"error": "Post not found"}), 404
-    comment = comments[cid]
     if comment is None:
         return json.dumps({"error": "Comment not found"}), 404
-    comment["text"] = text
-    return json.dumps(comment), 200
+    return json.dumps(comment.serialize()), 200
 
 
 @app.route("/api/posts/<int:pid>/", methods=["POST"])
 def upvote_post(pid):
     """
-    Upvotes the post with id, pid
+    Upvotes the post with id, pid. Upvotes that name a username count
+    once per user, and others change the count by at most one.
     """
-    post = posts.get(pid)
+    post = STORE.get_post(pid)
     if post is None:
         return json.dumps({"error": "Post not found"}), 404
-    if request.data:
-        body = json.loads(request.data)
-        upvotes = body.get("upvotes")
-        if upvotes is None:
-            upvotes = 1
-        elif not isinstance(upvotes, int):
-            return json.dumps({"error": "Upvotes must be of type <int>"}), 400
-    else:
-        upvotes = 1
-    post["upvotes"] += upvotes
-    return json.dumps(post), 200
+    body = json.loads(request.data) if request.data else {}
+    upvotes = body.get("upvotes")
+    if upvotes is not None and not isinstance(upvotes, int):
+        return json.dumps({"error": "Upvotes must be of type <int>"}), 400
+    if upvotes is not None and not MIN_UPVOTES <= post.upvotes + upvotes <= MAX_UPVOTES:
+        return json.dumps({"error": "Upvotes out of range"}), 400
+    username = body.get("username")
+    if username is None:
+        if UNIQUE_VOTES:
+            return json.dumps({"error": "Username required"}), 400
+        if upvotes not in (None, -1, 0, 1):
+            return json.dumps({"error": "Upvotes must be -1, 0 or 1"}), 400
+    if username is not None:
+        if not isinstance(username, str):
+            return json.dumps({"error": "Username must be of type <str>"}), 400
+        if upvotes not in (None, 1):
+            return json.dumps({"error": "Users can only upvote once"}), 400
+        post, voted = STORE.vote(pid, username)
+        if post is None:
+            return json.dumps({"error": "Post not found"}), 404
+        if not voted:
+            return json.dumps({"error": "Already upvoted"}), 409
+        return json.dumps(post.serialize()), 200
+    post = STORE.upvote_post(pid, 1 if upvotes is None else upvotes)
+    if post is None:
+        return json.dumps({"error": "Post not found"}), 404
+    return json.dumps(post.serialize()), 200
 
 
 @app.route("/api/extra/posts/")
 def extra_get_posts():
     """
-    Returns all posts
+    Returns all posts, optionally only those by username, sorted by
+    upvotes or hotness and paginated with limit and cursor
     """
     value = request.args.get("sort")
-    sorted_posts = posts
-    if value == "increasing":
-        sorted_posts = dict(sorted(posts.items(), key=lambda item: item[1]["upvotes"]))
-        print("increasing sorted: " + str(sorted_posts))
+    if value in ("increasing", "decreasing"):
+        cursor_type = "rank"
+    elif value == "hot":
+        cursor_type = "hot"
+    else:
+        cursor_type = "id"
+    limit, cursor, stream, error = page_args(cursor_type)
+    if error is not None:
+        return error
+    username = request.args.get("username")
+    if username is not None:
+        keys = user_post_keys(username, value, cursor)
+        lookup = serialized_post if cursor_type == "id" else serialized_post_by_rank
+    elif value == "increasing":
+        keys = STORE.ranked(cursor=cursor)
+        lookup = serialized_post_by_rank
     elif value == "decreasing":
-        sorted_posts = dict(sorted(posts.items(), key=lambda item: item[1]["upvotes"], reverse=True))
-        print("decreasing sorted: " + str(sorted_posts))
-    res = {"posts": list(sorted_posts.values())}
-    return json.dumps(res), 200
-    
+        keys = STORE.ranked(reverse=True, cursor=cursor)
+        lookup = serialized_post_by_rank
+    elif value == "hot":
+        keys = STORE.hot(cursor=cursor)
+        lookup = serialized_post_by_rank
+    else:
+        keys = STORE.ids(after=cursor)
+        lookup = serialized_post
+    return feed_response((value, username), keys, lookup, limit, stream)
+
+
+@app.route("/api/search")
+def search():
+    """
+    Returns the posts and comments best matching the query, q, up to limit
+    """
+    query = request.args.get("q")
+    if query is None:
+        return json.dumps({"error": "Query required"}), 400
+    limit = request.args.get("limit", "20")
+    if not limit.isdigit() or not 0 < int(limit) <= 100:
+        return json.dumps({"error": "Limit must be between 1 and 100"}), 400
+    results = []
+    for score, kind, pid, cid in STORE.search(query, int(limit)):
+        if kind == "post":
+            post = STORE.get_post(pid)
+            if post is not None:
+                results.append(
+                    b'{"type": "post", "score": %s, "post": %s}'
+                    % (json.dumps(score).encode(), post.to_json())
+                )
+        else:
+            comment = (STORE.get_comments(pid) or {}).get(cid)
+            if comment is not None:
+                results.append(
+                    b'{"type": "comment", "score": %s, "post_id": %d, "comment": %s}'
+                    % (json.dumps(score).encode(), pid, comment.to_json())
+                )
+    return b'{"results": [' + b", ".join(results) + b"]}", 200
+
+
+def subscribe_events(args, headers):
+    """
+    Subscribes to the events requested by the query params, args, and
+    request headers. Returns (subscriber, error), where error is a failure
+    response if the request is invalid.
+    """
+    pids = args.get("posts")
+    if pids is not None:
+        try:
+            pids = {int(pid) for pid in pids.split(",")}
+        except ValueError:
+            error = json.dumps({"error": "Posts must be comma-separated ids"})
+            return None, (error, 400)
+    last_event_id = headers.get("Last-Event-ID", args.get("last_event_id"))
+    if last_event_id is not None:
+        if not last_event_id.isdigit():
+            return None, (json.dumps({"error": "Invalid last event id"}), 400)
+        last_event_id = int(last_event_id)
+    return EVENTS.subscribe(pids, last_event_id), None
+
+
+# Headers of Server-Sent Events responses
+EVENT_STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.route("/api/posts/events")
+def post_events():
+    """
+    Streams post created, deleted and upvote events and comment events as
+    Server-Sent Events, optionally only for the comma-separated post ids
+    in posts. Clients resume with the Last-Event-ID header or the
+    last_event_id query param.
+    """
+    subscriber, error = subscribe_events(request.args, request.headers)
+    if error is not None:
+        return error
+    return Response(
+        subscriber.stream(),
+        mimetype="text/event-stream",
+        headers=EVENT_STREAM_HEADERS,
+    )
+
+
+def batch_items():
+    """
+    Returns an iterator over the items of a batch request body, or None if
+    the body is not valid. The body is either a JSON array or, with
+    Content-Type application/x-ndjson, one JSON value per line, which is
+    parsed from the request stream as it arrives. Lines that are not valid
+    JSON become None items.
+    """
+    if request.mimetype == "application/x-ndjson":
+        return ndjson_items(request.stream)
+    try:
+        items = json.loads(request.data)
+    except ValueError:
+        return None
+    return iter(items) if isinstance(items, list) else None
+
+
+def ndjson_items(stream):
+    """
+    Yields the JSON value on each non-blank line of stream
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def chunked(items, size):
+    """
+    Yields lists of up to size consecutive items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def batch_create(validate, create, key, conflict=None):
+    """
+    Validates each item of the batch request body with validate and calls
+    create with the field tuples of the valid items, a chunk at a time.
+    create returns the created records, with None for an item it refused
+    as a conflict, or None if their parent is gone. Returns a response with
+    one result per item, in order, with the record under key or the error,
+    which is conflict, with status 409, for refused items.
+    """
+    items = batch_items()
+    if items is None:
+        return json.dumps({"error": "Body must be a JSON array or NDJSON"}), 400
+    results = []
+    for chunk in chunked(items, BATCH_CHUNK_SIZE):
+        fields = []
+        positions = []
+        for item in chunk:
+            values, errors = validate(item)
+            if errors:
+                results.append({"status": 400, "error": errors[0], "errors": errors})
+                continue
+            fields.append(values)
+            positions.append(len(results))
+            results.append(None)
+        records = create(fields) if fields else []
+        if records is None:
+            for i in positions:
+                results[i] = {"status": 404, "error": "Post not found"}
+            continue
+        for i, record in zip(positions, records):
+            if record is None:
+                results[i] = {"status": 409, "error": conflict}
+            else:
+                results[i] = {"status": 201, key: record.serialize()}
+    return json.dumps({"results": results}), 200
+
+
+@app.route("/api/posts/batch/", methods=["POST"])
+def create_posts():
+    """
+    Creates posts in bulk from a JSON array or NDJSON body
+    """
+    return batch_create(
+        validate_extra_post,
+        lambda fields: STORE.create_posts(fields, unique_link=REJECT_DUPLICATE_LINKS),
+        "post",
+        "Link already posted",
+    )
+
+
+@app.route("/api/posts/<int:pid>/comments/batch/", methods=["POST"])
+def post_comments(pid):
+    """
+    Posts comments in bulk for the post with id, pid, from a JSON array or
+    NDJSON body
+    """
+    if STORE.get_comments(pid) is None:
+        return json.dumps({"error": "Post not found"}), 404
+    return batch_create(
+        validate_extra_comment,
+        lambda fields: STORE.create_comments(pid, fields),
+        "comment",
+    )
+
 
 @app.route("/<path:subpath>", methods=['GET', 'POST', 'PUT', 'DELETE'])
 def catch_all(subpath):
@@ -0,0 +1,305 @@
+"""
+ASGI entry point for the pa1 API, for running it on an event loop:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8000
+
+All routes are served by the Flask app in app.py, so the JSON contract is
+the same. The event loop owns every connection: request bodies are read
+and responses are written asynchronously, so slow and idle keep-alive
+clients hold no thread. Views run on a small fixed pool of threads only
+once a request has fully arrived, except for NDJSON bodies, which the view
+reads from the connection as they stream in, so a bulk import is never
+held in memory whole. Server-Sent Event streams are served on the loop
+itself, so each subscriber costs a coroutine, not a thread.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import sys
+from urllib.parse import parse_qsl
+
+from werkzeug.exceptions import ClientDisconnected
+
+import app as wsgi
+
+# Threads that run the Flask views
+VIEW_THREADS = int(os.environ.get("VIEW_THREADS", 8))
+
+# Bytes of a streamed response pulled from a view per thread hop
+STREAM_BATCH_SIZE = 64 * 1024
+
+EVENTS_PATH = "/api/posts/events"
+
+# Content types of request bodies passed to views as they arrive
+STREAMED_TYPES = (b"application/x-ndjson",)
+
+VIEWS = ThreadPoolExecutor(VIEW_THREADS, thread_name_prefix="view")
+
+
+async def read_body(receive):
+    """
+    Returns the request body once all of it has arrived
+    """
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    Request body that a view thread reads from the ASGI receive channel,
+    one message at a time as it asks for more
+    """
+
+    def __init__(self, receive, loop):
+        """
+        Initializes a stream over the body messages of receive, which is
+        awaited on loop
+        """
+        self.receive = receive
+        self.loop = loop
+        self.data = memoryview(b"")
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        """
+        Reads up to len(buffer) bytes of the body into buffer, waiting for
+        the next message when none are left. Returns 0 at the end of the
+        body. Raises ClientDisconnected if the client goes away first.
+        """
+        while not self.data and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(
+                self.receive(), self.loop
+            ).result()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            self.data = memoryview(message.get("body", b""))
+            self.more_body = message.get("more_body", False)
+        size = min(len(buffer), len(self.data))
+        buffer[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+
+def is_streamed(scope):
+    """
+    Returns whether the request body of scope is passed to the view as it
+    arrives, rather than read in full first
+    """
+    for name, value in scope["headers"]:
+        if name == b"content-type":
+            return value.split(b";", 1)[0].strip().lower() in STREAMED_TYPES
+    return False
+
+
+def make_environ(scope, stream, length=None):
+    """
+    Returns the WSGI environ for an ASGI HTTP scope whose request body is
+    read from stream. length is the length of the body if it has been read
+    in full. Otherwise the view reads stream until it ends.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope["http_version"],
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": stream,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    # A body read in full has a known length even when it arrived chunked,
+    # and a streamed one ends where the client ends it
+    if length is None:
+        environ["wsgi.input_terminated"] = True
+    else:
+        environ["CONTENT_LENGTH"] = str(length)
+    environ.pop("HTTP_TRANSFER_ENCODING", None)
+    return environ
+
+
+def body_message(data, more_body=False):
+    """
+    Returns the ASGI message that sends data as part of a response body
+    """
+    return {"type": "http.response.body", "body": data, "more_body": more_body}
+
+
+def next_batch(chunks):
+    """
+    Pulls up to STREAM_BATCH_SIZE bytes from a response iterator.
+    Returns (data, done).
+    """
+    batch = []
+    size = 0
+    for chunk in chunks:
+        if chunk:
+            batch.append(chunk)
+            size += len(chunk)
+        if size >= STREAM_BATCH_SIZE:
+            return b"".join(batch), False
+    return b"".join(batch), True
+
+
+def call_view(environ):
+    """
+    Runs the Flask app on environ. Returns (status, headers, body, chunks,
+    data, done), where body is the WSGI response iterable, data is the
+    first batch of it and chunks yields the rest unless done.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ]
+
+    body = wsgi.app(environ, start_response)
+    chunks = iter(body)
+    data, done = next_batch(chunks)
+    if done and hasattr(body, "close"):
+        body.close()
+    return response["status"], response["headers"], body, chunks, data, done
+
+
+async def serve_view(environ, send):
+    """
+    Serves a request with the Flask app, streaming the response body back
+    in batches so large and streamed responses never hold a whole thread
+    per client
+    """
+    loop = asyncio.get_running_loop()
+    status, headers, body, chunks, data, done = await loop.run_in_executor(
+        VIEWS, call_view, environ
+    )
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    try:
+        while not done:
+            await send(body_message(data, more_body=True))
+            data, done = await loop.run_in_executor(VIEWS, next_batch, chunks)
+        await send(body_message(data))
+    finally:
+        if not done and hasattr(body, "close"):
+            await loop.run_in_executor(VIEWS, body.close)
+
+
+def query_args(scope):
+    """
+    Returns the query params of scope, keeping the first value of each
+    """
+    args = {}
+    for name, value in parse_qsl(scope["query_string"].decode("latin-1")):
+        args.setdefault(name, value)
+    return args
+
+
+async def serve_events(scope, receive, send):
+    """
+    Streams Server-Sent Events on the event loop until the client goes
+    away. Returns False without responding if the request is invalid, so
+    the Flask view can answer it.
+    """
+    headers = {}
+    for name, value in scope["headers"]:
+        if name == b"last-event-id":
+            headers["Last-Event-ID"] = value.decode("latin-1")
+    subscriber, error = wsgi.subscribe_events(query_args(scope), headers)
+    if error is not None:
+        return False
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream; charset=utf-8")] + [
+            (name.lower().encode(), value.encode())
+            for name, value in wsgi.EVENT_STREAM_HEADERS.items()
+        ],
+    })
+    events = subscriber.astream()
+    disconnected = asyncio.ensure_future(receive())
+    try:
+        while True:
+            chunk = asyncio.ensure_future(events.__anext__())
+            await asyncio.wait(
+                (chunk, disconnected), return_when=asyncio.FIRST_COMPLETED
+            )
+            if not chunk.done():
+                chunk.cancel()
+                await asyncio.gather(chunk, return_exceptions=True)
+                return True
+            try:
+                data = chunk.result()
+            except StopAsyncIteration:
+                break
+            await send(body_message(data, more_body=True))
+        await send(body_message(b""))
+    finally:
+        disconnected.cancel()
+        await events.aclose()
+    return True
+
+
+async def lifespan(receive, send):
+    """
+    Acknowledges server startup and shutdown. The store is set up when
+    app.py is imported.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            VIEWS.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """
+    ASGI application serving the pa1 API
+    """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    if is_streamed(scope):
+        stream = ReceiveStream(receive, asyncio.get_running_loop())
+        environ = make_environ(scope, io.BufferedReader(stream, STREAM_BATCH_SIZE))
+        await serve_view(environ, send)
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    if scope["method"] == "GET" and scope["path"] == EVENTS_PATH:
+        if await serve_events(scope, receive, send):
+            return
+    await serve_view(make_environ(scope, io.BytesIO(body), len(body)), send)
@@ -0,0 +1,743 @@
+"""
+Benchmarks for the pa1 in-memory data structures.
+
+Usage: python bench.py <name> [<name> ...]
+Run with no arguments to list the available benchmarks.
+"""
+import asyncio
+from itertools import accumulate
+from itertools import islice
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from indexes import normalize_link
+from indexes import UpvoteIndex
+from indexes import VoterIndex
+from persistence import Journal
+from search import comment_doc
+from search import post_doc
+from search import SearchIndex
+from search import tokenize
+from shared import SharedStore
+from store import Post
+from store import PostStore
+from validation import compile_schema
+from validation import Field
+
+
+def timed(fn, repeat=5):
+    """
+    Returns the best wall-clock time of fn over repeat runs, in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_posts(n):
+    """
+    Returns a dict of n posts with random upvotes
+    """
+    return {
+        pid: Post(
+            pid,
+            random.randint(1, 10000),
+            "Post %d" % pid,
+            "https://i.imgur.com/%d.jpg" % pid,
+            "user%d" % (pid % 1000),
+        )
+        for pid in range(n)
+    }
+
+
+def bench_ranking():
+    """
+    Sorted feed reads: re-sorting the posts dict vs walking the upvote index
+    """
+    for n in (10_000, 1_000_000):
+        posts = make_posts(n)
+        index = UpvoteIndex()
+        for post in posts.values():
+            index.add_post(post)
+
+        def resort():
+            sorted(posts.items(), key=lambda item: item[1].upvotes, reverse=True)
+
+        def walk():
+            [posts[pid] for _, pid in index.descending()]
+
+        def walk_top():
+            [posts[pid] for _, pid in islice(index.descending(), 25)]
+
+        print("n=%d" % n)
+        print("  re-sort full feed:  %10.3f ms" % (timed(resort) * 1000))
+        print("  index full feed:    %10.3f ms" % (timed(walk) * 1000))
+        print("  index top 25:       %10.3f ms" % (timed(walk_top) * 1000))
+
+
+def bench_store_threads():
+    """
+    Multi-threaded stress test of the post store: each thread creates
+    posts, comments on them and upvotes a shared hot set of posts.
+    Checks for duplicate ids and lost upvotes, and reports throughput.
+    """
+    ops_per_thread = 20_000
+    for n_threads in (1, 2, 4, 8, 16):
+        store = PostStore()
+        hot = [store.create_post("hot", "link", "user") for _ in range(64)]
+
+        def worker(seed):
+            rng = random.Random(seed)
+            for _ in range(ops_per_thread // 4):
+                post = store.create_post("title", "link", "user%d" % seed)
+                store.create_comment(post.id, "text", "user%d" % seed)
+                store.upvote_post(rng.choice(hot).id)
+                store.upvote_post(post.id)
+
+        threads = [
+            threading.Thread(target=worker, args=(t,)) for t in range(n_threads)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+
+        n_ops = ops_per_thread * n_threads
+        n_posts = len(hot) + n_ops // 4
+        assert len(store.posts) == n_posts, "duplicate post ids"
+        cids = [cid for comments in store.comments_lists.values() for cid in comments]
+        assert len(cids) == len(set(cids)) == n_ops // 4, "duplicate comment ids"
+        hot_upvotes = sum(post.upvotes - 1 for post in hot)
+        assert hot_upvotes == n_ops // 4, "lost upvotes"
+        assert len(store.upvote_index) == n_posts, "index out of sync"
+        print(
+            "threads=%2d  %8.0f ops/s  (%d ops in %.2f s)"
+            % (n_threads, n_ops / elapsed, n_ops, elapsed)
+        )
+
+
+def bench_upvotes():
+    """
+    Upvote throughput on a single hot post, direct mutation vs coalesced.
+    Each upvote also serializes the post, as the upvote endpoint does.
+    """
+    ops_per_thread = 50_000
+    for n_threads in (1, 4, 16):
+        for name, staleness in (("direct", None), ("coalesced", 0.05)):
+            store = PostStore(upvote_staleness=staleness)
+            pid = store.create_post("hot", "link", "user").id
+
+            def worker():
+                for _ in range(ops_per_thread):
+                    store.upvote_post(pid).to_json()
+
+            threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+            start = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.perf_counter() - start
+            if staleness is not None:
+                store.flush_upvotes()
+
+            n_ops = ops_per_thread * n_threads
+            assert store.get_post(pid).upvotes == n_ops + 1, "lost upvotes"
+            print(
+                "threads=%2d  %-9s  %9.0f upvotes/s"
+                % (n_threads, name, n_ops / elapsed)
+            )
+
+
+def bench_cold_start():
+    """
+    Restart time for 1M posts: loading a snapshot plus a short log tail vs
+    replaying the whole log, and append throughput per fsync policy
+    """
+    n = 1_000_000
+    tail = 50_000
+    directory = tempfile.mkdtemp()
+    try:
+        store = PostStore()
+        journal = Journal(directory, fsync="off")
+        journal.recover(store)
+        start = time.perf_counter()
+        for i in range(n):
+            store.create_post(
+                "Post %d" % i, "https://i.imgur.com/%d.jpg" % i, "user%d" % (i % 1000)
+            )
+        print("logged %d posts in %.2f s" % (n, time.perf_counter() - start))
+        journal.close()
+
+        start = time.perf_counter()
+        store = PostStore()
+        journal = Journal(directory, fsync="off")
+        journal.recover(store)
+        print("cold start, log only:          %.2f s" % (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        journal.snapshot(store)
+        print("snapshot written in %.2f s" % (time.perf_counter() - start))
+        for i in range(tail):
+            store.upvote_post(random.randrange(n))
+        journal.close()
+
+        start = time.perf_counter()
+        store = PostStore()
+        journal = Journal(directory, fsync="off")
+        journal.recover(store)
+        print(
+            "cold start, snapshot + %dk tail: %.2f s"
+            % (tail // 1000, time.perf_counter() - start)
+        )
+        assert len(store.posts) == n
+        journal.close()
+    finally:
+        shutil.rmtree(directory)
+
+    for fsync in ("always", "batch", "off"):
+        directory = tempfile.mkdtemp()
+        try:
+            store = PostStore()
+            journal = Journal(directory, fsync=fsync)
+            journal.recover(store)
+            pid = store.create_post("hot", "link", "user").id
+            count = 2000 if fsync == "always" else 100_000
+            start = time.perf_counter()
+            for _ in range(count):
+                store.upvote_post(pid)
+            elapsed = time.perf_counter() - start
+            journal.close()
+            print("fsync=%-6s  %9.0f logged upvotes/s" % (fsync, count / elapsed))
+        finally:
+            shutil.rmtree(directory)
+
+
+def bench_import():
+    """
+    Import throughput through the Flask app: one request per post vs the
+    batch endpoint with a JSON array and with NDJSON
+    """
+    import json
+
+    import app
+
+    client = app.app.test_client()
+    n = 20_000
+    items = [
+        {
+            "title": "Post %d" % i,
+            "link": "https://i.imgur.com/%d.jpg" % i,
+            "username": "user%d" % (i % 1000),
+        }
+        for i in range(n)
+    ]
+
+    start = time.perf_counter()
+    for item in items[: n // 10]:
+        client.post("/api/extra/posts/", data=json.dumps(item))
+    single = (n // 10) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    client.post("/api/posts/batch/", data=json.dumps(items))
+    array = n / (time.perf_counter() - start)
+
+    body = "\n".join(json.dumps(item) for item in items)
+    start = time.perf_counter()
+    client.post("/api/posts/batch/", data=body, content_type="application/x-ndjson")
+    ndjson = n / (time.perf_counter() - start)
+
+    print("one request per post: %9.0f posts/s" % single)
+    print("batch, JSON array:    %9.0f posts/s" % array)
+    print("batch, NDJSON:        %9.0f posts/s" % ndjson)
+
+
+def measure_bytes(build):
+    """
+    Returns the number of bytes allocated and still held by build()
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def bench_memory():
+    """
+    Bytes per post held in a dict of plain dicts vs a dict of Post records.
+    Titles and links are shared between both runs so only the per-post
+    overhead and usernames are measured.
+    """
+    n = 500_000
+    titles = ["Post %d" % pid for pid in range(n)]
+    links = ["https://i.imgur.com/%d.jpg" % pid for pid in range(n)]
+
+    def username(pid):
+        # Built per post, as a decoded request body would be
+        return "user%d" % (pid % 1000)
+
+    def as_dicts():
+        return {
+            pid: {
+                "id": pid,
+                "upvotes": 1,
+                "title": titles[pid],
+                "link": links[pid],
+                "username": username(pid),
+            }
+            for pid in range(n)
+        }
+
+    def as_records():
+        return {
+            pid: Post(pid, 1, titles[pid], links[pid], username(pid))
+            for pid in range(n)
+        }
+
+    for name, build in (("dict", as_dicts), ("Post", as_records)):
+        print("%-5s %6.1f bytes/post" % (name, measure_bytes(build) / n))
+
+
+def bench_search():
+    """
+    Index size and query latency of SearchIndex over 500k post titles and
+    500k comments, against scanning every document for the query words
+    """
+    n = 500_000
+    vocabulary = ["word%d" % i for i in range(20000)]
+    # Zipf-like word frequencies, as in natural text
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+    def text(length):
+        return " ".join(random.choices(vocabulary, cum_weights=cum_weights, k=length))
+
+    titles = [text(6) for _ in range(n)]
+    comments = [text(20) for _ in range(n)]
+
+    def build():
+        index = SearchIndex()
+        for pid in range(n):
+            index.add(post_doc(pid), titles[pid])
+        for cid in range(n):
+            index.add(comment_doc(cid % n, cid), comments[cid])
+        return index
+
+    start = time.perf_counter()
+    index = build()
+    print("build       %8.2f s" % (time.perf_counter() - start))
+    print("index       %8.1f MB" % (measure_bytes(build) / 1e6))
+
+    def scan(query):
+        words = set(tokenize(query))
+        return [t for t in titles + comments if words & set(tokenize(t))]
+
+    for query in ("word3", "word500 word9000", "word19999"):
+        seconds = timed(lambda: index.search(query), repeat=3)
+        print("%-17s search %8.2f ms" % (query, seconds * 1000))
+    seconds = timed(lambda: scan("word9000"), repeat=1)
+    print("%-17s scan   %8.2f ms" % ("word9000", seconds * 1000))
+
+
+def bench_shared():
+    """
+    Multi-process stress test of SharedStore: each worker process reads
+    pages of the feed, creates posts and upvotes a shared hot set of posts.
+    Checks for lost upvotes and duplicate ids, and reports throughput.
+    """
+    ops_per_worker = 4_000
+    # Workers are forked so they can run a closure over the store
+    context = multiprocessing.get_context("fork")
+    print("cpus=%d" % os.cpu_count())
+    for n_workers in (1, 2, 4, 8):
+        directory = tempfile.mkdtemp()
+        try:
+            store = SharedStore(os.path.join(directory, "pa1.db"))
+            hot = [p.id for p in store.create_posts([("hot", "link", "user")] * 64)]
+
+            def worker(seed):
+                rng = random.Random(seed)
+                for _ in range(ops_per_worker // 4):
+                    keys = list(islice(store.ranked(reverse=True), 25))
+                    for key in keys:
+                        store.get_post(key[1])
+                    post = store.create_post("title", "link", "user%d" % seed)
+                    store.upvote_post(rng.choice(hot))
+                    store.upvote_post(post.id)
+
+            workers = [
+                context.Process(target=worker, args=(w,))
+                for w in range(n_workers)
+            ]
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.perf_counter() - start
+
+            n_ops = ops_per_worker * n_workers
+            ids = list(store.ids())
+            assert len(ids) == len(set(ids)) == 64 + n_ops // 4, "duplicate ids"
+            hot_upvotes = sum(store.get_post(pid).upvotes - 1 for pid in hot)
+            assert hot_upvotes == n_ops // 4, "lost upvotes"
+            print(
+                "workers=%d  %8.0f ops/s  (%d ops in %.2f s)"
+                % (n_workers, n_ops / elapsed, n_ops, elapsed)
+            )
+        finally:
+            shutil.rmtree(directory)
+
+
+def bench_votes():
+    """
+    Bytes per vote and membership check time of a VoterIndex vs a set of
+    usernames per post, for 1M votes by 100k users on 10k posts
+    """
+    n_posts, n_users, n_votes = 10_000, 100_000, 1_000_000
+    # Built per vote, as a decoded request body would be
+    votes = [
+        (random.randrange(n_posts), "user%d" % random.randrange(n_users))
+        for _ in range(n_votes)
+    ]
+
+    def as_sets():
+        voters = {}
+        for pid, username in votes:
+            voters.setdefault(pid, set()).add(username)
+        return voters
+
+    def as_index():
+        voters = VoterIndex()
+        for pid, username in votes:
+            voters.add(pid, username)
+        return voters
+
+    sets, index = as_sets(), as_index()
+    n_unique = sum(len(voters) for voters in sets.values())
+    sample = votes[:100_000]
+    checks = {
+        "set": lambda: [username in sets[pid] for pid, username in sample],
+        "VoterIndex": lambda: [index.has(pid, username) for pid, username in sample],
+    }
+    for name, build in (("set", as_sets), ("VoterIndex", as_index)):
+        print(
+            "%-10s %6.1f bytes/vote  %5.2f us/check"
+            % (
+                name,
+                measure_bytes(build) / n_unique,
+                timed(checks[name], repeat=3) / len(sample) * 1e6,
+            )
+        )
+
+
+def bench_links():
+    """
+    Duplicate-link check through the store's link index vs a scan over
+    every post, at 1M posts
+    """
+    store = PostStore()
+    store.create_posts(
+        [("Post", "https://i.imgur.com/%d.jpg" % i, "user") for i in range(1_000_000)]
+    )
+    link = "http://www.i.imgur.com/999999.jpg/?utm_source=feed"
+    key = normalize_link(link)
+
+    def scan():
+        return [
+            post.id
+            for post in store.posts.values()
+            if normalize_link(post.link) == key
+        ]
+
+    assert store.posts_with_link(link) == scan() == [999999]
+    print("index %10.3f ms" % (timed(lambda: store.posts_with_link(link)) * 1000))
+    print("scan  %10.3f ms" % (timed(scan, repeat=1) * 1000))
+
+
+def bench_comment_summaries():
+    """
+    Time to get the comment count and top 3 comments for a page of 25
+    posts with 1000 comments each, from the maintained ranking vs sorting
+    each post's comments
+    """
+    store = PostStore()
+    posts = store.create_posts([("Post", "link", "user")] * 25)
+    for post in posts:
+        store.create_comments(
+            post.id, [("text", "user%d" % i) for i in range(1000)]
+        )
+        for comment in store.get_comments(post.id).values():
+            comment.upvotes = random.randint(1, 10000)
+        store.get_comments(post.id).rank()
+
+    def maintained():
+        return [store.comment_summary(post.id, 3) for post in posts]
+
+    def sorted_per_request():
+        summaries = []
+        for post in posts:
+            comments = store.get_comments(post.id)
+            top = sorted(comments.values(), key=lambda c: (-c.upvotes, c.id))[:3]
+            summaries.append((len(comments), top))
+        return summaries
+
+    assert maintained() == sorted_per_request()
+    print("maintained %8.3f ms/page" % (timed(maintained) * 1000))
+    print("sorted     %8.3f ms/page" % (timed(sorted_per_request) * 1000))
+
+
+async def http_get(reader, writer, path):
+    """
+    Sends a keep-alive GET for path. Returns (body, whether the server
+    keeps the connection open).
+    """
+    writer.write(b"GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path.encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    keep_alive = head.startswith(b"HTTP/1.1")
+    for line in head.lower().split(b"\r\n"):
+        if line.startswith(b"content-length:"):
+            length = int(line.split(b":")[1])
+        elif line == b"connection: close":
+            keep_alive = False
+    return await reader.readexactly(length), keep_alive
+
+
+async def load_server(port, n_streams, n_clients, seconds):
+    """
+    Holds n_streams Server-Sent Events connections open against the server
+    on port while n_clients keep-alive clients fetch a post for seconds.
+    Returns (requests/s, p50 ms, p99 ms, failed requests, streams that
+    got an event).
+    """
+    streams = []
+    for _ in range(n_streams):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(b"GET /api/posts/events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            streams.append((reader, writer))
+        except OSError:
+            break
+    await asyncio.sleep(1)
+    latencies = []
+    deadline = time.perf_counter() + seconds
+
+    errors = []
+
+    async def client():
+        writer = None
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                _, keep_alive = await http_get(reader, writer, "/api/posts/1/")
+                if not keep_alive:
+                    writer.close()
+                    writer = None
+            except (asyncio.IncompleteReadError, OSError):
+                errors.append(start)
+                writer = None
+                continue
+            latencies.append(time.perf_counter() - start)
+        if writer is not None:
+            writer.close()
+
+    await asyncio.gather(*(client() for _ in range(n_clients)))
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        b"POST /api/posts/1/ HTTP/1.1\r\nHost: localhost\r\n"
+        b"Content-Length: 0\r\n\r\n"
+    )
+    await writer.drain()
+
+    async def received(stream):
+        try:
+            await asyncio.wait_for(stream[0].readuntil(b"event: upvote"), 10)
+            return True
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            return False
+
+    delivered = sum(await asyncio.gather(*(received(s) for s in streams)))
+    for _, stream_writer in streams:
+        stream_writer.close()
+    writer.close()
+    latencies.sort()
+    return (
+        len(latencies) / seconds,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[len(latencies) * 99 // 100] * 1000,
+        len(errors),
+        delivered,
+    )
+
+
+def server_usage(pid):
+    """
+    Returns (threads, resident MB) of the process with id, pid
+    """
+    usage = {}
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            usage[name] = value.split()[:1]
+    return int(usage["Threads"][0]), int(usage["VmRSS"][0]) / 1024
+
+
+def bench_asgi():
+    """
+    The WSGI app on Flask's threaded server vs the ASGI app on uvicorn,
+    each holding 2000 idle Server-Sent Events streams while 100 keep-alive
+    clients fetch posts
+    """
+    servers = {
+        "wsgi": [
+            sys.executable, "-c",
+            "import app; app.app.run(port=8101, threaded=True)",
+        ],
+        "asgi": [
+            sys.executable, "-m", "uvicorn", "asgi:application",
+            "--port", "8102", "--log-level", "warning",
+        ],
+    }
+    for port, (name, command) in enumerate(servers.items(), 8101):
+        server = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            time.sleep(3)
+            rps, p50, p99, errors, delivered = asyncio.run(
+                load_server(port, 2000, 100, 5)
+            )
+            threads, rss = server_usage(server.pid)
+            print(
+                "%s  %6.0f req/s  p50 %7.1f ms  p99 %7.1f ms  errors %5d"
+                "  events %4d/2000  threads %4d  rss %5.0f MB"
+                % (name, rps, p50, p99, errors, delivered, threads, rss)
+            )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def inline_post_error(body):
+    """
+    Returns the first error in a post body, checked the way the handlers
+    did before schemas, or None if it is valid
+    """
+    title = body.get("title")
+    if title is None:
+        return "Title required"
+    elif not isinstance(title, str):
+        return "Title must be of type <str>"
+    link = body.get("link")
+    if link is None:
+        return "Link required"
+    elif not isinstance(link, str):
+        return "Link must be of type <str>"
+    username = body.get("username")
+    if username is None:
+        return "Username required"
+    elif not isinstance(username, str):
+        return "Username must be of type <str>"
+    return None
+
+
+def bench_validation():
+    """
+    Per-body cost of the post schema vs inline checks, for valid and
+    invalid bodies and a batch of 100k items, and the schema's share of a
+    whole POST /api/extra/posts/ request
+    """
+    import json
+
+    import app
+
+    validate = compile_schema(
+        Field("title", str), Field("link", str), Field("username", str)
+    )
+    valid = {"title": "Post", "link": "https://i.imgur.com/0.jpg", "username": "u"}
+    invalid = {"title": 1, "link": "https://i.imgur.com/0.jpg"}
+    batch = [valid if i % 10 else invalid for i in range(100_000)]
+
+    def run(check, bodies):
+        def check_all():
+            for body in bodies:
+                check(body)
+
+        return check_all
+
+    per_body = {}
+    for name, body in (("valid", valid), ("invalid", invalid)):
+        bodies = [body] * 100_000
+        per_body[name] = timed(run(validate, bodies)) / len(bodies)
+        print(
+            "%-8s inline %6.3f us  schema %6.3f us"
+            % (
+                name,
+                timed(run(inline_post_error, bodies)) / len(bodies) * 1e6,
+                per_body[name] * 1e6,
+            )
+        )
+    print(
+        "batch    inline %6.1f ms  schema %6.1f ms"
+        % (
+            timed(run(inline_post_error, batch)) * 1000,
+            timed(run(validate, batch)) * 1000,
+        )
+    )
+
+    client = app.app.test_client()
+    data = json.dumps(valid)
+
+    def post_all():
+        for _ in range(2000):
+            client.post("/api/extra/posts/", data=data)
+
+    per_request = timed(post_all, repeat=3) / 2000
+    print(
+        "request  %6.1f us, of which the schema %.2f%%"
+        % (per_request * 1e6, per_body["valid"] / per_request * 100)
+    )
+
+
+BENCHMARKS = {
+    "ranking": bench_ranking,
+    "store-threads": bench_store_threads,
+    "memory": bench_memory,
+    "upvotes": bench_upvotes,
+    "cold-start": bench_cold_start,
+    "import": bench_import,
+    "search": bench_search,
+    "shared": bench_shared,
+    "votes": bench_votes,
+    "links": bench_links,
+    "comment-summaries": bench_comment_summaries,
+    "asgi": bench_asgi,
+    "validation": bench_validation,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    if not names:
+        print("Available benchmarks: " + ", ".join(BENCHMARKS))
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,172 @@
+import asyncio
+from collections import deque
+import threading
+
+OVERFLOW = b"event: overflow\ndata: {}\n\n"
+KEEP_ALIVE = b": keep-alive\n\n"
+
+
+class Subscriber(object):
+    """
+    One client of an EventBus, with a bounded buffer of pending events.
+    If the client falls more than buffer_size events behind, it is
+    disconnected and can resume from its last event id.
+    """
+
+    def __init__(self, bus, pids, buffer_size):
+        """
+        Initializes a subscriber to the posts with ids in pids, or to all
+        posts if pids is None
+        """
+        self.bus = bus
+        self.pids = pids
+        self.buffer_size = buffer_size
+        self.pending = deque()
+        self.ready = threading.Condition(threading.Lock())
+        self.overflowed = False
+        self.wakeup = None
+
+    def wants(self, pid):
+        """
+        Returns whether the subscriber wants events for the post with id, pid
+        """
+        return self.pids is None or pid in self.pids
+
+    def push(self, event):
+        """
+        Queues an encoded event, marking the subscriber as overflowed if its
+        buffer is full
+        """
+        with self.ready:
+            if self.overflowed:
+                return
+            if len(self.pending) >= self.buffer_size:
+                self.overflowed = True
+            else:
+                self.pending.append(event)
+            self.ready.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def drain(self, timeout=0):
+        """
+        Waits up to timeout seconds for events, then takes the pending
+        events. Returns (events, overflowed).
+        """
+        with self.ready:
+            if timeout and not self.pending and not self.overflowed:
+                self.ready.wait(timeout)
+            events = list(self.pending)
+            self.pending.clear()
+            return events, self.overflowed
+
+    def stream(self, heartbeat=15):
+        """
+        Yields encoded events as they arrive, and a comment line every
+        heartbeat seconds without events to keep the connection open.
+        Ends with an overflow event if the client fell too far behind.
+        """
+        try:
+            while True:
+                events, overflowed = self.drain(heartbeat)
+                if events:
+                    yield b"".join(events)
+                elif overflowed:
+                    yield OVERFLOW
+                    return
+                else:
+                    yield KEEP_ALIVE
+        finally:
+            self.bus.unsubscribe(self)
+
+    async def astream(self, heartbeat=15):
+        """
+        Like stream(), but waits for events on the running event loop
+        instead of blocking a thread
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        self.wakeup = lambda: loop.call_soon_threadsafe(ready.set)
+        try:
+            while True:
+                ready.clear()
+                events, overflowed = self.drain()
+                if events:
+                    yield b"".join(events)
+                elif overflowed:
+                    yield OVERFLOW
+                    return
+                else:
+                    try:
+                        await asyncio.wait_for(ready.wait(), heartbeat)
+                    except asyncio.TimeoutError:
+                        yield KEEP_ALIVE
+        finally:
+            self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+    """
+    Publishes post events to Server-Sent Events subscribers.
+
+    Events are encoded once, when published, and shared by all subscribers.
+    The last history_size events are kept so clients that reconnect with
+    the id of the last event they saw get everything they missed.
+    """
+
+    def __init__(self, history_size=10000, buffer_size=256):
+        """
+        Initializes a bus with no subscribers
+        """
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.history = deque(maxlen=history_size)
+        self.subscribers = set()
+        self.buffer_size = buffer_size
+
+    def publish(self, event_type, pid, data):
+        """
+        Sends an event about the post with id, pid, whose data is the given
+        JSON bytes, to every interested subscriber
+        """
+        with self.lock:
+            event_id = self.next_id
+            self.next_id += 1
+            event = b"id: %d\nevent: %s\ndata: %s\n\n" % (
+                event_id,
+                event_type.encode(),
+                data,
+            )
+            self.history.append((event_id, pid, event))
+            for subscriber in self.subscribers:
+                if subscriber.wants(pid):
+                    subscriber.push(event)
+
+    def subscribe(self, pids=None, last_event_id=None):
+        """
+        Returns a new subscriber to the posts with ids in pids, or to all
+        posts if pids is None. If last_event_id is given, the events after
+        it are queued first, regardless of the buffer size; if they are no
+        longer in the history, or last_event_id was never sent, e.g. by an
+        earlier process whose ids ran further, a reset event tells the
+        client to refetch.
+        """
+        subscriber = Subscriber(self, pids, self.buffer_size)
+        with self.lock:
+            if last_event_id is not None:
+                oldest = self.history[0][0] if self.history else self.next_id
+                if last_event_id + 1 < oldest or last_event_id >= self.next_id:
+                    subscriber.pending.append(b"event: reset\ndata: {}\n\n")
+                else:
+                    for event_id, pid, event in self.history:
+                        if event_id > last_event_id and subscriber.wants(pid):
+                            subscriber.pending.append(event)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """
+        Stops sending events to subscriber
+        """
+        with self.lock:
+            self.subscribers.discard(subscriber)
@@ -0,0 +1,360 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+import math
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# Seconds of post age that are worth a 10x difference in upvotes
+HOT_DECAY = 45000
+
+# Query params that only track where a click came from
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+
+class SortedIndex(object):
+    """
+    Ordered index of keys kept sorted as items are added and removed.
+    Keys are stored in bounded sorted chunks so inserts and removals
+    only shift one chunk, and reads walk the keys in order without
+    re-sorting.
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.chunks = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def load(self, keys):
+        """
+        Replaces the contents of the index with keys, which must be sorted
+        """
+        self.chunks = [
+            keys[i : i + self.CHUNK_SIZE] for i in range(0, len(keys), self.CHUNK_SIZE)
+        ]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.size = len(keys)
+
+    def add(self, key):
+        """
+        Inserts key into the index
+        """
+        self.size += 1
+        if not self.chunks:
+            self.chunks.append([key])
+            self.maxes.append(key)
+            return
+        c = bisect_left(self.maxes, key)
+        if c == len(self.chunks):
+            c -= 1
+            self.chunks[c].append(key)
+            self.maxes[c] = key
+        else:
+            insort(self.chunks[c], key)
+        chunk = self.chunks[c]
+        if len(chunk) > 2 * self.CHUNK_SIZE:
+            self.chunks.insert(c + 1, chunk[self.CHUNK_SIZE :])
+            del chunk[self.CHUNK_SIZE :]
+            self.maxes.insert(c, chunk[-1])
+
+    def remove(self, key):
+        """
+        Removes key from the index, if present
+        """
+        c = bisect_left(self.maxes, key)
+        if c == len(self.chunks):
+            return
+        chunk = self.chunks[c]
+        i = bisect_left(chunk, key)
+        if chunk[i] != key:
+            return
+        del chunk[i]
+        self.size -= 1
+        if not chunk:
+            del self.chunks[c]
+            del self.maxes[c]
+        elif i == len(chunk):
+            self.maxes[c] = chunk[-1]
+
+    def replace(self, old_key, new_key):
+        """
+        Moves an item from old_key to new_key
+        """
+        self.remove(old_key)
+        self.add(new_key)
+
+    def ascending(self, after=None):
+        """
+        Yields keys in increasing order, starting after the key, after
+        """
+        c = 0 if after is None else bisect_right(self.maxes, after)
+        if c == len(self.chunks):
+            return
+        i = 0 if after is None else bisect_right(self.chunks[c], after)
+        for chunk in self.chunks[c:]:
+            yield from chunk[i:]
+            i = 0
+
+    def descending(self, before=None):
+        """
+        Yields keys in decreasing order, starting before the key, before
+        """
+        if before is None:
+            c = len(self.chunks) - 1
+            i = None
+        else:
+            c = min(bisect_left(self.maxes, before), len(self.chunks) - 1)
+            i = bisect_left(self.chunks[c], before) if c >= 0 else None
+        while c >= 0:
+            chunk = self.chunks[c]
+            yield from reversed(chunk[:i] if i is not None else chunk)
+            c -= 1
+            i = None
+
+
+class UpvoteIndex(SortedIndex):
+    """
+    Index of post ids ranked by upvotes.
+    Keys are (upvotes, pid) so ties are broken by id.
+    """
+
+    def add_post(self, post):
+        """
+        Inserts post into the ranking
+        """
+        self.add((post.upvotes, post.id))
+
+    def remove_post(self, post):
+        """
+        Removes post from the ranking
+        """
+        self.remove((post.upvotes, post.id))
+
+    def update_upvotes(self, post, old_upvotes):
+        """
+        Moves post to its new rank after its upvotes changed from old_upvotes
+        """
+        self.replace((old_upvotes, post.id), (post.upvotes, post.id))
+
+
+def hot_score(upvotes, created):
+    """
+    Returns the hot score of a post with upvotes, created at the unix time,
+    created. Each 10x in upvotes is worth HOT_DECAY seconds of recency.
+
+    The score grows with creation time instead of shrinking with age, so a
+    post's score only changes when it is upvoted, yet newer posts still
+    overtake older ones with the same votes as time passes.
+    """
+    sign = (upvotes > 0) - (upvotes < 0)
+    return round(sign * math.log10(max(abs(upvotes), 1)) + created / HOT_DECAY, 7)
+
+
+class HotIndex(SortedIndex):
+    """
+    Index of post ids ranked by hot score.
+    Keys are (score, pid) so ties are broken by id.
+    """
+
+    def add_post(self, post):
+        """
+        Inserts post into the ranking
+        """
+        self.add((hot_score(post.upvotes, post.created), post.id))
+
+    def remove_post(self, post):
+        """
+        Removes post from the ranking
+        """
+        self.remove((hot_score(post.upvotes, post.created), post.id))
+
+    def update_upvotes(self, post, old_upvotes):
+        """
+        Moves post to its new rank after its upvotes changed from old_upvotes
+        """
+        self.replace(
+            (hot_score(old_upvotes, post.created), post.id),
+            (hot_score(post.upvotes, post.created), post.id),
+        )
+
+
+class UsernameIndex(object):
+    """
+    Index from username to the keys of the items that user created, in
+    the order they were added
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.keys = {}
+
+    def add(self, username, key):
+        """
+        Records that username created the item with key. Only string
+        usernames are indexed, since only those can be looked up.
+        """
+        if isinstance(username, str):
+            self.keys.setdefault(username, {})[key] = None
+
+    def remove(self, username, key):
+        """
+        Forgets the item with key created by username
+        """
+        if not isinstance(username, str):
+            return
+        keys = self.keys.get(username)
+        if keys is not None:
+            keys.pop(key, None)
+            if not keys:
+                del self.keys[username]
+
+    def get(self, username):
+        """
+        Returns the keys of the items created by username, oldest first
+        """
+        return list(self.keys.get(username, ()))
+
+
+class VoterIndex(object):
+    """
+    Index from post id to the users who voted on it, for one vote per
+    user per post.
+
+    Usernames are interned to integer user ids, and each post keeps the
+    ids of its voters in a sorted array('I'): 4 bytes per vote, with
+    O(log n) membership checks by bisection.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.user_ids = {}
+        self.usernames = []
+        self.voters = {}
+
+    def user_id(self, username):
+        """
+        Returns the integer id of username, assigning the next one if it
+        has none yet
+        """
+        uid = self.user_ids.get(username)
+        if uid is None:
+            uid = self.user_ids[username] = len(self.usernames)
+            self.usernames.append(username)
+        return uid
+
+    def add(self, pid, username):
+        """
+        Records a vote by username on the post with id, pid.
+        Returns False if username had already voted on it.
+        """
+        uid = self.user_id(username)
+        voters = self.voters.get(pid)
+        if voters is None:
+            self.voters[pid] = array("I", [uid])
+            return True
+        i = bisect_left(voters, uid)
+        if i < len(voters) and voters[i] == uid:
+            return False
+        voters.insert(i, uid)
+        return True
+
+    def has(self, pid, username):
+        """
+        Returns whether username voted on the post with id, pid
+        """
+        uid = self.user_ids.get(username)
+        voters = self.voters.get(pid)
+        if uid is None or voters is None:
+            return False
+        i = bisect_left(voters, uid)
+        return i < len(voters) and voters[i] == uid
+
+    def remove_post(self, pid):
+        """
+        Forgets the votes on the post with id, pid
+        """
+        self.voters.pop(pid, None)
+
+    def get(self, pid):
+        """
+        Returns the usernames of the voters on the post with id, pid
+        """
+        return [self.usernames[uid] for uid in self.voters.get(pid, ())]
+
+
+def normalize_link(link):
+    """
+    Returns the key under which link is indexed, so links to the same page
+    match: the scheme, "www.", default ports, trailing slashes, fragments
+    and tracking params are dropped, the host is lowercased and the query
+    params are sorted
+    """
+    link = link.strip()
+    try:
+        parts = urlsplit(link if "//" in link else "//" + link)
+        port = parts.port
+    except ValueError:
+        return link.lower()
+    host = (parts.hostname or "").removeprefix("www.")
+    if port is not None and port not in (80, 443):
+        host += ":%d" % port
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.startswith(TRACKING_PARAMS)
+    )
+    key = host + parts.path.rstrip("/")
+    if query:
+        key += "?" + urlencode(query)
+    return key
+
+
+class LinkIndex(object):
+    """
+    Hash index from normalized link to the ids of the posts with that link
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.pids = {}
+
+    def add(self, link, pid):
+        """
+        Records that the post with id, pid, has link. Only string links are
+        indexed.
+        """
+        if isinstance(link, str):
+            self.pids.setdefault(normalize_link(link), {})[pid] = None
+
+    def remove(self, link, pid):
+        """
+        Forgets that the post with id, pid, has link
+        """
+        if not isinstance(link, str):
+            return
+        key = normalize_link(link)
+        pids = self.pids.get(key)
+        if pids is not None:
+            pids.pop(pid, None)
+            if not pids:
+                del self.pids[key]
+
+    def get(self, link):
+        """
+        Returns the ids of the posts with link, oldest first
+        """
+        if not isinstance(link, str):
+            return []
+        return list(self.pids.get(normalize_link(link), ()))
@@ -0,0 +1,95 @@
+import base64
+import binascii
+import json
+
+from flask import Response
+
+
+def encode_cursor(key):
+    """
+    Encodes an index key into an opaque cursor string
+    """
+    raw = json.dumps(key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor string back into an index key.
+    Raises ValueError if the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError("Invalid cursor")
+    if isinstance(key, list):
+        key = tuple(key)
+    return key
+
+
+def parse_page_args(args):
+    """
+    Parses the limit, cursor and stream query params.
+    Returns (limit, cursor_key, stream), where limit and cursor_key are
+    None when not given. Raises ValueError with a client-facing message.
+    """
+    limit = args.get("limit")
+    if limit is not None:
+        if not limit.isdigit() or int(limit) == 0:
+            raise ValueError("Limit must be a positive integer")
+        limit = int(limit)
+    cursor = args.get("cursor")
+    if cursor is not None:
+        cursor = decode_cursor(cursor)
+    stream = args.get("stream", "").lower() in ("1", "true")
+    return limit, cursor, stream
+
+
+def iter_page(keys, lookup, limit, state):
+    """
+    Yields up to limit items for keys, skipping keys whose lookup returns
+    None. Sets state["next_cursor"] if more items remain.
+    """
+    count = 0
+    last_key = None
+    for key in keys:
+        item = lookup(key)
+        if item is None:
+            continue
+        if limit is not None and count == limit:
+            state["next_cursor"] = encode_cursor(last_key)
+            return
+        yield item
+        count += 1
+        last_key = key
+
+
+def render_listing(name, keys, lookup, limit=None):
+    """
+    Yields the JSON listing {name: [...]} in byte chunks, one item at a
+    time. lookup maps each key to the item's serialized JSON bytes.
+    The listing is paginated if limit is given, in which case it includes
+    a next_cursor, or null on the last page.
+    """
+    state = {}
+    yield b'{"%s": [' % name.encode()
+    first = True
+    for item in iter_page(keys, lookup, limit, state):
+        if first:
+            first = False
+            yield item
+        else:
+            yield b", " + item
+    if limit is not None:
+        next_cursor = json.dumps(state.get("next_cursor")).encode()
+        yield b'], "next_cursor": %s}' % next_cursor
+    else:
+        yield b"]}"
+
+
+def stream_response(chunks):
+    """
+    Returns a response that streams chunks from a generator
+    """
+    return Response(chunks, 200, mimetype="application/json")
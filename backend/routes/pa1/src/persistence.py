@@ -0,0 +1,482 @@
+import json
+import os
+import struct
+import threading
+import zlib
+
+from store import Comment
+from store import clamp_upvotes
+from store import CommentList
+from store import Post
+
+CREATE_POST = 1
+DELETE_POST = 2
+UPVOTE_POST = 3
+CREATE_COMMENT = 4
+EDIT_COMMENT = 5
+VOTERS = 6
+VOTE = 7
+
+FRAME = struct.Struct("<II")
+OP = struct.Struct("<B")
+INT = struct.Struct("<q")
+FLOAT = struct.Struct("<d")
+VALUE = struct.Struct("<BI")
+
+SNAPSHOT_MAGIC = b"PA1SNAP2"
+# Magic, first log segment after the snapshot, next post id, next comment id
+SNAPSHOT_HEADER = struct.Struct("<8sQqq")
+# Snapshots written before the next ids were stored
+SNAPSHOT_MAGIC_V1 = b"PA1SNAP1"
+SNAPSHOT_HEADER_V1 = struct.Struct("<8sQ")
+
+FSYNC_POLICIES = ("always", "batch", "off")
+
+
+def pack_value(value):
+    """
+    Packs a field value. Strings are stored as UTF-8; anything else a
+    client sent (numbers, lists, ...) is stored as JSON.
+    """
+    if isinstance(value, str):
+        data = value.encode("utf-8", "surrogatepass")
+        return VALUE.pack(0, len(data)) + data
+    data = json.dumps(value).encode()
+    return VALUE.pack(1, len(data)) + data
+
+
+def unpack_value(buf, offset):
+    """
+    Unpacks a field value at offset. Returns (value, new offset).
+    """
+    tag, size = VALUE.unpack_from(buf, offset)
+    offset += VALUE.size
+    data = buf[offset : offset + size]
+    if tag == 0:
+        value = str(data, "utf-8", "surrogatepass")
+    else:
+        value = json.loads(bytes(data))
+    return value, offset + size
+
+
+def post_fields(post):
+    """
+    Returns the fields of post that its record stores, as a tuple
+    """
+    return (post.id, post.upvotes, post.created, post.title, post.link, post.username)
+
+
+def post_record(fields):
+    """
+    Returns the record that recreates the post with fields from post_fields
+    """
+    pid, upvotes, created, title, link, username = fields
+    return (
+        OP.pack(CREATE_POST)
+        + INT.pack(pid)
+        + INT.pack(upvotes)
+        + FLOAT.pack(created)
+        + pack_value(title)
+        + pack_value(link)
+        + pack_value(username)
+    )
+
+
+def comment_fields(comment):
+    """
+    Returns the fields of comment that its record stores, as a tuple
+    """
+    return (comment.id, comment.upvotes, comment.text, comment.username)
+
+
+def comment_record(pid, fields):
+    """
+    Returns the record that recreates the comment with fields from
+    comment_fields on the post with id, pid
+    """
+    cid, upvotes, text, username = fields
+    return (
+        OP.pack(CREATE_COMMENT)
+        + INT.pack(pid)
+        + INT.pack(cid)
+        + INT.pack(upvotes)
+        + pack_value(text)
+        + pack_value(username)
+    )
+
+
+def frame(payload):
+    """
+    Prefixes payload with its length and checksum
+    """
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_frames(buf, offset=0):
+    """
+    Yields the payloads framed in buf, starting at offset. Stops at the
+    first torn or corrupt frame, which is what a crash mid-write leaves.
+    Payloads are memoryviews into buf, so no bytes are copied.
+    """
+    buf = memoryview(buf)
+    end = len(buf)
+    while offset + FRAME.size <= end:
+        size, crc = FRAME.unpack_from(buf, offset)
+        start = offset + FRAME.size
+        if start + size > end:
+            return
+        payload = buf[start : start + size]
+        if zlib.crc32(payload) != crc:
+            return
+        yield payload
+        offset = start + size
+
+
+def voters_record(pid, usernames):
+    """
+    Returns the record that adds usernames to the voters on the post with
+    id, pid
+    """
+    return OP.pack(VOTERS) + INT.pack(pid) + pack_value(usernames)
+
+
+def apply_record(store, payload):
+    """
+    Applies one logged mutation directly to the posts and comments dicts,
+    the voter index and the id allocators of a store that is being
+    recovered. The store's other indexes are rebuilt once all records are
+    applied. Created ids are never handed out again, even once deleted.
+    """
+    posts = store.posts
+    comments_lists = store.comments_lists
+    voters = store.voters
+    op = payload[0]
+    offset = OP.size
+    pid = INT.unpack_from(payload, offset)[0]
+    offset += INT.size
+    if op == CREATE_POST:
+        upvotes = INT.unpack_from(payload, offset)[0]
+        created = FLOAT.unpack_from(payload, offset + INT.size)[0]
+        title, offset = unpack_value(payload, offset + INT.size + FLOAT.size)
+        link, offset = unpack_value(payload, offset)
+        username, offset = unpack_value(payload, offset)
+        posts[pid] = Post(pid, upvotes, title, link, username, created)
+        comments_lists[pid] = CommentList()
+        store.pids.advance(pid)
+    elif op == DELETE_POST:
+        posts.pop(pid, None)
+        comments_lists.pop(pid, None)
+        voters.remove_post(pid)
+    elif op == UPVOTE_POST:
+        post = posts.get(pid)
+        if post is not None:
+            post.upvotes = clamp_upvotes(
+                post.upvotes + INT.unpack_from(payload, offset)[0]
+            )
+    elif op == CREATE_COMMENT:
+        cid, upvotes = struct.unpack_from("<qq", payload, offset)
+        text, offset = unpack_value(payload, offset + 2 * INT.size)
+        username, offset = unpack_value(payload, offset)
+        store.cids.advance(cid)
+        comments = comments_lists.get(pid)
+        if comments is not None:
+            comments[cid] = Comment(cid, upvotes, text, username)
+    elif op == EDIT_COMMENT:
+        cid = INT.unpack_from(payload, offset)[0]
+        text, offset = unpack_value(payload, offset + INT.size)
+        comment = comments_lists.get(pid, {}).get(cid)
+        if comment is not None:
+            comment.text = text
+    elif op == VOTERS:
+        if pid in posts:
+            for username in unpack_value(payload, offset)[0]:
+                voters.add(pid, username)
+    elif op == VOTE:
+        post = posts.get(pid)
+        if post is not None:
+            voters.add(pid, unpack_value(payload, offset)[0])
+            post.upvotes = clamp_upvotes(post.upvotes + 1)
+
+
+class Journal(object):
+    """
+    Durability layer for a PostStore.
+
+    Every mutation is appended to a log segment as a compact binary record
+    before it is applied. Snapshots of the whole store are written
+    periodically, each starting a new log segment, so a restart loads the
+    latest snapshot and replays only the segments written after it.
+
+    fsync is one of:
+    - "always": fsync after every record
+    - "batch": fsync every fsync_interval seconds in a background thread
+    - "off": leave syncing to the OS
+
+    Records are flushed to the OS as they are appended under every policy,
+    so a crash of the process alone never loses them.
+    """
+
+    def __init__(self, directory, fsync="batch", fsync_interval=0.05):
+        """
+        Initializes a journal that keeps its files in directory
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync must be one of " + ", ".join(FSYNC_POLICIES))
+        self.directory = directory
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.log = None
+        self.segment = 0
+        self.records = 0
+        self.dirty = False
+        self.sync_thread = None
+        self.snapshot_thread = None
+        self.closed = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        """
+        Returns the path of the journal file, name
+        """
+        return os.path.join(self.directory, name)
+
+    def segment_name(self, segment):
+        """
+        Returns the file name of the log segment numbered segment
+        """
+        return "log.%06d" % segment
+
+    def segments(self):
+        """
+        Returns the numbers of the log segments on disk, in order
+        """
+        return sorted(
+            int(name[4:])
+            for name in os.listdir(self.directory)
+            if name.startswith("log.") and name[4:].isdigit()
+        )
+
+    def is_empty(self):
+        """
+        Returns whether nothing has been persisted yet
+        """
+        return not self.segments() and not os.path.exists(self.path("snapshot"))
+
+    def recover(self, store):
+        """
+        Loads the latest snapshot and the log tail into store, then attaches
+        the journal to store so its mutations are logged from now on
+        """
+        first_segment = 0
+        if os.path.exists(self.path("snapshot")):
+            with open(self.path("snapshot"), "rb") as f:
+                buf = f.read()
+            magic = buf[: len(SNAPSHOT_MAGIC)]
+            if magic == SNAPSHOT_MAGIC:
+                header = SNAPSHOT_HEADER.unpack_from(buf)
+                _, first_segment, next_pid, next_cid = header
+                store.pids.advance(next_pid - 1)
+                store.cids.advance(next_cid - 1)
+                offset = SNAPSHOT_HEADER.size
+            elif magic == SNAPSHOT_MAGIC_V1:
+                first_segment = SNAPSHOT_HEADER_V1.unpack_from(buf)[1]
+                offset = SNAPSHOT_HEADER_V1.size
+            else:
+                raise ValueError("Not a snapshot file: " + self.path("snapshot"))
+            for payload in read_frames(buf, offset):
+                apply_record(store, payload)
+        segments = [s for s in self.segments() if s >= first_segment]
+        for segment in segments:
+            with open(self.path(self.segment_name(segment)), "rb") as f:
+                buf = f.read()
+            for payload in read_frames(buf):
+                apply_record(store, payload)
+                self.records += 1
+        store.rebuild()
+        self.segment = segments[-1] + 1 if segments else first_segment
+        self.open_segment()
+        if self.fsync == "batch":
+            self.sync_thread = threading.Thread(target=self.run_syncs, daemon=True)
+            self.sync_thread.start()
+        store.journal = self
+
+    def open_segment(self):
+        """
+        Starts appending to a fresh log segment
+        """
+        name = self.path(self.segment_name(self.segment))
+        self.log = open(name, "ab")
+        self.fsync_directory()
+
+    def fsync_directory(self):
+        """
+        Makes created and renamed files in the directory durable
+        """
+        if self.fsync == "off" or not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, payload):
+        """
+        Appends one record to the log, syncing it per the fsync policy
+        """
+        data = frame(payload)
+        with self.lock:
+            self.log.write(data)
+            self.log.flush()
+            self.records += 1
+            if self.fsync == "always":
+                self.sync()
+            else:
+                self.dirty = True
+
+    def run_syncs(self):
+        """
+        Syncs the log every fsync_interval seconds while records are being
+        appended. The fsync runs on a duplicate of the log's descriptor, so
+        appends are not held up while it waits for the disk.
+        """
+        while not self.closed.wait(self.fsync_interval):
+            with self.lock:
+                if not self.dirty:
+                    continue
+                self.dirty = False
+                fd = os.dup(self.log.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def sync(self):
+        """
+        Flushes the log to disk. Must be called with the lock held.
+        """
+        self.log.flush()
+        if self.fsync != "off":
+            os.fsync(self.log.fileno())
+        self.dirty = False
+
+    def log_create_post(self, post):
+        """
+        Logs the creation of post
+        """
+        self.append(post_record(post_fields(post)))
+
+    def log_delete_post(self, pid):
+        """
+        Logs the deletion of the post with id, pid
+        """
+        self.append(OP.pack(DELETE_POST) + INT.pack(pid))
+
+    def log_upvote_post(self, pid, upvotes):
+        """
+        Logs upvotes added to the post with id, pid
+        """
+        self.append(OP.pack(UPVOTE_POST) + INT.pack(pid) + INT.pack(upvotes))
+
+    def log_create_comment(self, pid, comment):
+        """
+        Logs the creation of comment on the post with id, pid
+        """
+        self.append(comment_record(pid, comment_fields(comment)))
+
+    def log_edit_comment(self, pid, cid, text):
+        """
+        Logs a new text for the comment with id, cid
+        """
+        self.append(
+            OP.pack(EDIT_COMMENT) + INT.pack(pid) + INT.pack(cid) + pack_value(text)
+        )
+
+    def log_vote(self, pid, username):
+        """
+        Logs a vote by username on the post with id, pid, with the upvote
+        it adds
+        """
+        self.append(OP.pack(VOTE) + INT.pack(pid) + pack_value(username))
+
+    def snapshot(self, store):
+        """
+        Writes a snapshot of store and starts a new log segment.
+
+        Mutations are paused only while the field values of the posts,
+        comments and votes are copied; they are encoded and written to the
+        snapshot file afterwards. Older segments are removed once the
+        snapshot is safely on disk.
+        """
+        with store.frozen():
+            with self.lock:
+                self.sync()
+                self.log.close()
+                self.segment += 1
+                self.open_segment()
+                self.records = 0
+                first_segment = self.segment
+            next_pid = store.pids.next_id
+            next_cid = store.cids.next_id
+            posts = store.posts
+            all_posts = [post_fields(posts[pid]) for pid in store.ids()]
+            all_comments = [
+                (pid, [comment_fields(comment) for comment in comments.values()])
+                for pid, comments in store.comments_lists.items()
+                if comments
+            ]
+            all_voters = [
+                (pid, voter_ids[:]) for pid, voter_ids in store.voters.voters.items()
+            ]
+        # Usernames are only ever appended, so the user ids copied above
+        # stay valid while mutations go on
+        usernames = store.voters.usernames
+        tmp = self.path("snapshot.tmp")
+        with open(tmp, "wb") as f:
+            f.write(
+                SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, first_segment, next_pid, next_cid)
+            )
+            for fields in all_posts:
+                f.write(frame(post_record(fields)))
+            for pid, comments in all_comments:
+                for fields in comments:
+                    f.write(frame(comment_record(pid, fields)))
+            for pid, voter_ids in all_voters:
+                voter_names = [usernames[uid] for uid in voter_ids]
+                f.write(frame(voters_record(pid, voter_names)))
+            f.flush()
+            if self.fsync != "off":
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path("snapshot"))
+        self.fsync_directory()
+        for segment in self.segments():
+            if segment < first_segment:
+                os.remove(self.path(self.segment_name(segment)))
+
+    def start_snapshots(self, store, interval):
+        """
+        Snapshots store every interval seconds in a background thread,
+        skipping intervals in which nothing was logged
+        """
+
+        def run():
+            while not self.closed.wait(interval):
+                if self.records:
+                    self.snapshot(store)
+
+        self.snapshot_thread = threading.Thread(target=run, daemon=True)
+        self.snapshot_thread.start()
+
+    def close(self):
+        """
+        Stops background snapshots and syncs and flushes the log
+        """
+        self.closed.set()
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+        with self.lock:
+            self.sync()
+            self.log.close()
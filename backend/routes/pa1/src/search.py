@@ -0,0 +1,190 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+import math
+import re
+
+TOKEN = re.compile(r"\w+")
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+# Ids are packed into 64-bit document numbers, so they must be below this
+MAX_ID = 1 << 31
+
+
+def tokenize(text):
+    """
+    Returns the lowercased word tokens of text, or no tokens if text is not
+    a string
+    """
+    if not isinstance(text, str):
+        return []
+    return TOKEN.findall(text.lower())
+
+
+def post_doc(pid):
+    """
+    Returns the document number of the post with id, pid
+    """
+    return pid << 1
+
+
+def comment_doc(pid, cid):
+    """
+    Returns the document number of the comment with id, cid, on the post
+    with id, pid. Numbers grow with cid so new comments append to the
+    comment postings.
+    """
+    return ((cid << 31 | pid) << 1) | 1
+
+
+def parse_doc(doc):
+    """
+    Returns ("post", pid, None) or ("comment", pid, cid) for a document
+    number
+    """
+    if doc & 1 == 0:
+        return "post", doc >> 1, None
+    doc >>= 1
+    return "comment", doc & (MAX_ID - 1), doc >> 31
+
+
+class SearchIndex(object):
+    """
+    Inverted index over post titles and comment text.
+
+    Each token maps to two posting lists, one for posts and one for
+    comments: sorted arrays of the 64-bit numbers of the documents that
+    contain it, repeated once per occurrence. Post numbers grow with the
+    post id and comment numbers with the comment id, but every comment
+    number is above every post number, so the two kinds are kept apart and
+    adding a new document appends to its postings. Removals and edits
+    bisect into them. Results are ranked with BM25.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty index
+        """
+        self.postings = {}
+        self.comment_postings = {}
+        self.lengths = {}
+        self.total_length = 0
+
+    def add(self, doc, text):
+        """
+        Indexes the tokens of text under the document number, doc
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        index = self.comment_postings if doc & 1 else self.postings
+        for token in tokens:
+            postings = index.get(token)
+            if postings is None:
+                index[token] = array("q", [doc])
+            elif postings[-1] <= doc:
+                postings.append(doc)
+            else:
+                postings.insert(bisect_right(postings, doc), doc)
+        self.lengths[doc] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, doc, text):
+        """
+        Removes the document number, doc, which was indexed with text
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        index = self.comment_postings if doc & 1 else self.postings
+        for token in set(tokens):
+            postings = index.get(token)
+            if postings is None:
+                continue
+            lo = bisect_left(postings, doc)
+            hi = bisect_right(postings, doc, lo)
+            del postings[lo:hi]
+            if not postings:
+                del index[token]
+        self.total_length -= self.lengths.pop(doc, 0)
+
+    def add_post(self, post):
+        """
+        Indexes the title of post
+        """
+        self.add(post_doc(post.id), post.title)
+
+    def remove_post(self, post, comments):
+        """
+        Removes post and its comments from the index
+        """
+        self.remove(post_doc(post.id), post.title)
+        for comment in comments.values():
+            self.remove_comment(post.id, comment)
+
+    def add_comment(self, pid, comment):
+        """
+        Indexes the text of comment on the post with id, pid
+        """
+        self.add(comment_doc(pid, comment.id), comment.text)
+
+    def remove_comment(self, pid, comment):
+        """
+        Removes comment on the post with id, pid, from the index
+        """
+        self.remove(comment_doc(pid, comment.id), comment.text)
+
+    def matches(self, query):
+        """
+        Returns (n_docs, avg_length, postings) for query: the document count
+        and mean length of the index, and for each token of query a copy of
+        its post and comment postings joined. Scoring them with score()
+        needs no lock, so callers hold the index's lock only while this
+        copies them.
+        """
+        n_docs = len(self.lengths)
+        if n_docs == 0:
+            return 0, 0, []
+        postings = []
+        for token in set(tokenize(query)):
+            token_postings = array("q")
+            for index in (self.postings, self.comment_postings):
+                index_postings = index.get(token)
+                if index_postings is not None:
+                    token_postings += index_postings
+            if token_postings:
+                postings.append(token_postings)
+        return n_docs, self.total_length / n_docs, postings
+
+    def score(self, matches, limit=20):
+        """
+        Returns up to limit (score, doc) pairs for the documents in matches
+        from matches(), best first. Documents removed from the index since
+        are left out.
+        """
+        n_docs, avg_length, postings = matches
+        lengths = self.lengths
+        scores = {}
+        for token_postings in postings:
+            counts = {}
+            for doc in token_postings:
+                counts[doc] = counts.get(doc, 0) + 1
+            df = len(counts)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc, tf in counts.items():
+                length = lengths.get(doc)
+                if length is None:
+                    continue
+                norm = K1 * (1 - B + B * length / avg_length)
+                scores[doc] = scores.get(doc, 0) + idf * tf * (K1 + 1) / (tf + norm)
+        return heapq.nlargest(limit, ((s, d) for d, s in scores.items()))
+
+    def search(self, query, limit=20):
+        """
+        Returns up to limit (score, doc) pairs for the documents matching
+        any token of query, best first
+        """
+        return self.score(self.matches(query), limit)
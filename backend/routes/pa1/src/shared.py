@@ -0,0 +1,669 @@
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+
+from indexes import hot_score
+from indexes import normalize_link
+from search import comment_doc
+from search import parse_doc
+from search import post_doc
+from search import tokenize
+from store import Comment
+from store import CommentList
+from store import Post
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    upvotes INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    link TEXT NOT NULL,
+    username TEXT NOT NULL,
+    link_key TEXT,
+    created REAL NOT NULL,
+    hot REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    comments_version INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posts_by_upvotes ON posts (upvotes, id);
+CREATE INDEX IF NOT EXISTS posts_by_hot ON posts (hot, id);
+CREATE INDEX IF NOT EXISTS posts_by_username ON posts (username, id);
+CREATE INDEX IF NOT EXISTS posts_by_link ON posts (link_key, id);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    post_id INTEGER NOT NULL,
+    upvotes INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    username TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS comments_by_post ON comments (post_id, id);
+CREATE INDEX IF NOT EXISTS comments_by_upvotes ON comments (
+    post_id, upvotes DESC, id
+);
+CREATE INDEX IF NOT EXISTS comments_by_username ON comments (username, id);
+CREATE TABLE IF NOT EXISTS votes (
+    post_id INTEGER NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (post_id, username)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5 (text);
+"""
+
+# Bytes of the database file each connection memory-maps
+MMAP_SIZE = 1 << 30
+
+# Rows fetched per round trip when iterating over index keys
+FETCH_SIZE = 1000
+
+
+def pack(value):
+    """
+    Packs a field value as JSON text, so values of any type a client sent
+    come back unchanged
+    """
+    return json.dumps(value)
+
+
+def link_key(link):
+    """
+    Returns the normalized key of link, or None if link is not a string
+    """
+    return normalize_link(link) if isinstance(link, str) else None
+
+
+def post_from_row(row):
+    """
+    Returns the Post record for a (id, upvotes, title, link, username,
+    created, version) row
+    """
+    post = Post(
+        row[0], row[1], json.loads(row[2]), json.loads(row[3]),
+        json.loads(row[4]), row[5]
+    )
+    post.version = row[6]
+    return post
+
+
+def comment_from_row(row):
+    """
+    Returns the Comment record for a (id, upvotes, text, username, version)
+    row
+    """
+    comment = Comment(row[0], row[1], json.loads(row[2]), json.loads(row[3]))
+    comment.version = row[4]
+    return comment
+
+
+def fts_query(query):
+    """
+    Returns an FTS5 query matching any token of query, or None if query
+    has no tokens
+    """
+    tokens = set(tokenize(query))
+    if not tokens:
+        return None
+    return " OR ".join('"%s"' % token for token in tokens)
+
+
+class SharedStore(object):
+    """
+    Post store kept in a SQLite database file, so every worker process on
+    the host shares one copy of the posts and comments.
+
+    The file is memory-mapped by each connection and opened in WAL mode:
+    readers never block each other or the writer, and each read statement
+    sees a consistent snapshot. Writes take SQLite's database lock, so
+    mutations from all processes are serialized. Each thread gets its own
+    connection, opened lazily and reopened after a fork.
+
+    It has the same interface as PostStore. The store version and epoch
+    live in the database, so ETags are valid across workers. The feed
+    cache and the event bus are per process: a worker only publishes the
+    events for mutations it made itself. Upvotes are always applied
+    immediately.
+    """
+
+    def __init__(self, path):
+        """
+        Initializes a store backed by the database file at path, creating
+        it if needed
+        """
+        self.path = path
+        self.local = threading.local()
+        self.feed_cache = {}
+        self.events = None
+        self.connection().executescript(SCHEMA)
+        with self.write() as db:
+            db.execute(
+                "INSERT OR IGNORE INTO meta VALUES "
+                "('epoch', ?), ('version', 0), ('comment_version', 0)",
+                (os.urandom(4).hex(),),
+            )
+        self.epoch = self.connection().execute(
+            "SELECT value FROM meta WHERE key = 'epoch'"
+        ).fetchone()[0]
+
+    def connection(self):
+        """
+        Returns the calling thread's connection, opening it if needed
+        """
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            db = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None, check_same_thread=False
+            )
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            db.execute("PRAGMA mmap_size = %d" % MMAP_SIZE)
+            db.create_function("hot_score", 2, hot_score, deterministic=True)
+            self.local.db = db
+            self.local.pid = pid
+        return self.local.db
+
+    @contextmanager
+    def write(self):
+        """
+        Runs the block in a write transaction, taking the database lock up
+        front. Commits if the block succeeds and rolls back otherwise.
+        """
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @contextmanager
+    def read(self):
+        """
+        Runs the block in a read transaction, so all its queries see the
+        same snapshot
+        """
+        db = self.connection()
+        db.execute("BEGIN")
+        try:
+            yield db
+        finally:
+            db.execute("COMMIT")
+
+    def touch(self, db):
+        """
+        Bumps the store version after a post mutation. Must be called in a
+        write transaction.
+        """
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+
+    @property
+    def version(self):
+        """
+        The store version, shared by all workers
+        """
+        return self.connection().execute(
+            "SELECT value FROM meta WHERE key = 'version'"
+        ).fetchone()[0]
+
+    @property
+    def comment_version(self):
+        """
+        The version of all comments, shared by all workers
+        """
+        return self.connection().execute(
+            "SELECT value FROM meta WHERE key = 'comment_version'"
+        ).fetchone()[0]
+
+    def touch_comments(self, db, pid):
+        """
+        Bumps the versions of the comments of the post with id, pid, and
+        of all comments. Must be called in a write transaction.
+        Returns False if the post does not exist.
+        """
+        updated = db.execute(
+            "UPDATE posts SET comments_version = comments_version + 1 "
+            "WHERE id = ?",
+            (pid,),
+        ).rowcount
+        db.execute(
+            "UPDATE meta SET value = value + 1 WHERE key = 'comment_version'"
+        )
+        return bool(updated)
+
+    def load(self, posts, comments_lists):
+        """
+        Loads existing posts and comments, given as dicts keyed by id,
+        into the store, unless a worker has already loaded them
+        """
+        with self.write() as db:
+            loaded = db.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('loaded', 1)"
+            ).rowcount
+            if not loaded:
+                return
+            for pid, post in posts.items():
+                self.insert_post(db, Post(**post))
+                for comment in comments_lists.get(pid, {}).values():
+                    self.insert_comment(db, pid, Comment(**comment))
+
+    def insert_post(self, db, post):
+        """
+        Inserts post, or a new post if its id is None, and indexes its
+        title. Returns the post id. Must be called in a write transaction.
+        """
+        pid = db.execute(
+            "INSERT INTO posts (id, upvotes, title, link, username, link_key, "
+            "created, hot) VALUES (?, ?, ?, ?, ?, ?, ?, hot_score(?, ?))",
+            (
+                post.id, post.upvotes, pack(post.title), pack(post.link),
+                pack(post.username), link_key(post.link), post.created,
+                post.upvotes, post.created,
+            ),
+        ).lastrowid
+        if isinstance(post.title, str):
+            db.execute(
+                "INSERT INTO search (rowid, text) VALUES (?, ?)",
+                (post_doc(pid), post.title),
+            )
+        self.touch(db)
+        return pid
+
+    def insert_comment(self, db, pid, comment):
+        """
+        Inserts comment, or a new comment if its id is None, on the post
+        with id, pid, and indexes its text. Returns the comment id. Must be
+        called in a write transaction.
+        """
+        cid = db.execute(
+            "INSERT INTO comments (id, post_id, upvotes, text, username) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                comment.id, pid, comment.upvotes, pack(comment.text),
+                pack(comment.username),
+            ),
+        ).lastrowid
+        db.execute(
+            "UPDATE posts SET comment_count = comment_count + 1 WHERE id = ?",
+            (pid,),
+        )
+        if isinstance(comment.text, str):
+            db.execute(
+                "INSERT INTO search (rowid, text) VALUES (?, ?)",
+                (comment_doc(pid, cid), comment.text),
+            )
+        return cid
+
+    def cached_feed(self, key, build, version=None):
+        """
+        Returns the feed body cached in this process under key for the
+        given version, by default the current store version, calling
+        build() to create it if it is missing or stale
+        """
+        if version is None:
+            version = self.version
+        cached = self.feed_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        data = build()
+        if any(entry[0] != version for entry in self.feed_cache.values()):
+            self.feed_cache = {}
+        self.feed_cache[key] = (version, data)
+        return data
+
+    def maybe_flush_upvotes(self):
+        """
+        Does nothing: upvotes are never coalesced in a shared store
+        """
+
+    def get_post(self, pid):
+        """
+        Returns the post with id, pid, or None if it does not exist
+        """
+        row = self.connection().execute(
+            "SELECT id, upvotes, title, link, username, created, version "
+            "FROM posts WHERE id = ?",
+            (pid,),
+        ).fetchone()
+        return None if row is None else post_from_row(row)
+
+    def create_post(self, title, link, username, unique_link=False):
+        """
+        Creates a new post and returns it. If unique_link is set, returns
+        None instead if a post with the same normalized link exists.
+        """
+        if not unique_link:
+            return self.create_posts([(title, link, username)])[0]
+        post = Post(None, 1, title, link, username)
+        with self.write() as db:
+            if self.posts_with_link(link):
+                return None
+            post.id = self.insert_post(db, post)
+        if self.events is not None:
+            self.events.publish("post-created", post.id, post.to_json())
+        return post
+
+    def create_posts(self, fields, unique_link=False):
+        """
+        Creates a post for each (title, link, username) in fields, in one
+        transaction. Returns the new posts, in the order of fields. If
+        unique_link is set, an item whose normalized link is already posted,
+        or repeats that of an earlier item, is not created and gets None in
+        its place.
+        """
+        posts = [
+            Post(None, 1, title, link, username) for title, link, username in fields
+        ]
+        with self.write() as db:
+            for i, post in enumerate(posts):
+                if unique_link and self.posts_with_link(post.link):
+                    posts[i] = None
+                    continue
+                post.id = self.insert_post(db, post)
+        if self.events is not None:
+            for post in posts:
+                if post is not None:
+                    self.events.publish("post-created", post.id, post.to_json())
+        return posts
+
+    def delete_post(self, pid):
+        """
+        Deletes the post with id, pid, and its comments.
+        Returns the deleted post, or None if it does not exist.
+        """
+        with self.write() as db:
+            post = self.get_post(pid)
+            if post is None:
+                return None
+            docs = [(post_doc(pid),)] + [
+                (comment_doc(pid, cid),)
+                for (cid,) in db.execute(
+                    "SELECT id FROM comments WHERE post_id = ?", (pid,)
+                )
+            ]
+            db.executemany("DELETE FROM search WHERE rowid = ?", docs)
+            db.execute("DELETE FROM comments WHERE post_id = ?", (pid,))
+            db.execute("DELETE FROM votes WHERE post_id = ?", (pid,))
+            db.execute("DELETE FROM posts WHERE id = ?", (pid,))
+            self.touch(db)
+        if self.events is not None:
+            self.events.publish("post-deleted", pid, b'{"id": %d}' % pid)
+        return post
+
+    def upvote_post(self, pid, upvotes=1):
+        """
+        Adds upvotes to the post with id, pid.
+        Returns the updated post, or None if it does not exist.
+        """
+        with self.write() as db:
+            updated = db.execute(
+                "UPDATE posts SET upvotes = upvotes + ?, version = version + 1, "
+                "hot = hot_score(upvotes + ?, created) WHERE id = ?",
+                (upvotes, upvotes, pid),
+            ).rowcount
+            if not updated:
+                return None
+            self.touch(db)
+            post = self.get_post(pid)
+        if self.events is not None:
+            self.events.publish("upvote", pid, post.to_json())
+        return post
+
+    def vote(self, pid, username):
+        """
+        Upvotes the post with id, pid, on behalf of username, at most once
+        per user. Returns (post, voted), where post is None if it does not
+        exist and voted is False if username had already voted on it.
+        """
+        with self.write() as db:
+            post = self.get_post(pid)
+            if post is None:
+                return None, False
+            voted = db.execute(
+                "INSERT OR IGNORE INTO votes VALUES (?, ?)", (pid, username)
+            ).rowcount
+            if not voted:
+                return post, False
+            db.execute(
+                "UPDATE posts SET upvotes = upvotes + 1, version = version + 1, "
+                "hot = hot_score(upvotes + 1, created) WHERE id = ?",
+                (pid,),
+            )
+            self.touch(db)
+            post = self.get_post(pid)
+        if self.events is not None:
+            self.events.publish("upvote", pid, post.to_json())
+        return post, True
+
+    def publish_comment(self, event_type, pid, comment):
+        """
+        Publishes an event about comment on the post with id, pid, if an
+        event bus is attached
+        """
+        if self.events is not None:
+            data = b'{"post_id": %d, "comment": %s}' % (pid, comment.to_json())
+            self.events.publish(event_type, pid, data)
+
+    def get_comments(self, pid):
+        """
+        Returns the comments dict for the post with id, pid, or None if
+        the post does not exist. The dict is a snapshot; changes to it are
+        not saved.
+        """
+        with self.read() as db:
+            return self.comment_list(db, pid)
+
+    def comment_list(self, db, pid):
+        """
+        Returns the comments dict for the post with id, pid, or None if
+        the post does not exist. Must be called in a transaction.
+        """
+        row = db.execute(
+            "SELECT comments_version FROM posts WHERE id = ?", (pid,)
+        ).fetchone()
+        if row is None:
+            return None
+        comments = CommentList(
+            (comment[0], comment_from_row(comment))
+            for comment in db.execute(
+                "SELECT id, upvotes, text, username, version FROM comments "
+                "WHERE post_id = ? ORDER BY id",
+                (pid,),
+            )
+        )
+        comments.version = row[0]
+        return comments
+
+    def comment_summary(self, pid, k):
+        """
+        Returns (count, top) for the post with id, pid, where top is its k
+        comments with the most upvotes, or None if the post does not exist
+        """
+        with self.read() as db:
+            row = db.execute(
+                "SELECT comment_count FROM posts WHERE id = ?", (pid,)
+            ).fetchone()
+            if row is None:
+                return None
+            top = [
+                comment_from_row(comment)
+                for comment in db.execute(
+                    "SELECT id, upvotes, text, username, version FROM comments "
+                    "WHERE post_id = ? ORDER BY upvotes DESC, id LIMIT ?",
+                    (pid, k),
+                )
+            ]
+        return row[0], top
+
+    def create_comment(self, pid, text, username):
+        """
+        Creates a new comment on the post with id, pid.
+        Returns the comment, or None if the post does not exist.
+        """
+        created = self.create_comments(pid, [(text, username)])
+        return None if created is None else created[0]
+
+    def create_comments(self, pid, fields):
+        """
+        Creates a comment on the post with id, pid, for each (text, username)
+        in fields, in one transaction. Returns the new comments, or None if
+        the post does not exist.
+        """
+        created = [Comment(None, 1, text, username) for text, username in fields]
+        with self.write() as db:
+            if not self.touch_comments(db, pid):
+                return None
+            for comment in created:
+                comment.id = self.insert_comment(db, pid, comment)
+        for comment in created:
+            self.publish_comment("comment-created", pid, comment)
+        return created
+
+    def edit_comment(self, pid, cid, text):
+        """
+        Replaces the text of the comment with id, cid, on the post with
+        id, pid. Returns (comments, comment), where either is None if the
+        post or comment does not exist.
+        """
+        with self.write() as db:
+            updated = db.execute(
+                "UPDATE comments SET text = ?, version = version + 1 "
+                "WHERE id = ? AND post_id = ?",
+                (pack(text), cid, pid),
+            ).rowcount
+            if updated:
+                self.touch_comments(db, pid)
+                db.execute(
+                    "DELETE FROM search WHERE rowid = ?", (comment_doc(pid, cid),)
+                )
+                if isinstance(text, str):
+                    db.execute(
+                        "INSERT INTO search (rowid, text) VALUES (?, ?)",
+                        (comment_doc(pid, cid), text),
+                    )
+            comments = self.comment_list(db, pid)
+        if comments is None:
+            return None, None
+        comment = comments.get(cid)
+        if comment is not None:
+            self.publish_comment("comment-edited", pid, comment)
+        return comments, comment
+
+    def keys(self, query, params):
+        """
+        Yields the rows of query, fetched FETCH_SIZE at a time. The rows
+        all come from the snapshot taken when the query started, and so do
+        lookups made on this thread while it runs.
+        """
+        cursor = self.connection().execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def ids(self, after=None):
+        """
+        Yields post ids in increasing order, starting after the id, after
+        """
+        rows = self.keys(
+            "SELECT id FROM posts WHERE id > ? ORDER BY id",
+            (-1 if after is None else after,),
+        )
+        return (row[0] for row in rows)
+
+    def ranked(self, reverse=False, cursor=None):
+        """
+        Yields (upvotes, id) rank keys in increasing order, or decreasing
+        if reverse is set, starting past the rank key, cursor
+        """
+        if cursor is None:
+            order = "DESC" if reverse else "ASC"
+            return self.keys(
+                "SELECT upvotes, id FROM posts "
+                "ORDER BY upvotes %s, id %s" % (order, order),
+                (),
+            )
+        if reverse:
+            return self.keys(
+                "SELECT upvotes, id FROM posts WHERE (upvotes, id) < (?, ?) "
+                "ORDER BY upvotes DESC, id DESC",
+                cursor,
+            )
+        return self.keys(
+            "SELECT upvotes, id FROM posts WHERE (upvotes, id) > (?, ?) "
+            "ORDER BY upvotes, id",
+            cursor,
+        )
+
+    def hot(self, cursor=None):
+        """
+        Yields (score, id) hot keys from hottest to coldest, starting past
+        the hot key, cursor
+        """
+        if cursor is None:
+            return self.keys(
+                "SELECT hot, id FROM posts ORDER BY hot DESC, id DESC", ()
+            )
+        return self.keys(
+            "SELECT hot, id FROM posts WHERE (hot, id) < (?, ?) "
+            "ORDER BY hot DESC, id DESC",
+            cursor,
+        )
+
+    def posts_by(self, username):
+        """
+        Returns the ids of the posts created by username, in id order
+        """
+        rows = self.connection().execute(
+            "SELECT id FROM posts WHERE username = ? ORDER BY id", (pack(username),)
+        )
+        return [row[0] for row in rows]
+
+    def posts_with_link(self, link):
+        """
+        Returns the ids of the posts whose link normalizes to the same key
+        as link, in id order
+        """
+        key = link_key(link)
+        if key is None:
+            return []
+        rows = self.connection().execute(
+            "SELECT id FROM posts WHERE link_key = ? ORDER BY id", (key,)
+        )
+        return [row[0] for row in rows]
+
+    def comments_by(self, username):
+        """
+        Returns (pid, cid) for the comments created by username, in
+        comment id order
+        """
+        return self.connection().execute(
+            "SELECT post_id, id FROM comments WHERE username = ? ORDER BY id",
+            (pack(username),),
+        ).fetchall()
+
+    def search(self, query, limit=20):
+        """
+        Returns up to limit (score, kind, pid, cid) results for the posts
+        and comments matching query, best first. kind is "post" or
+        "comment", and cid is None for posts.
+        """
+        query = fts_query(query)
+        if query is None:
+            return []
+        rows = self.connection().execute(
+            "SELECT -bm25(search), rowid FROM search WHERE search MATCH ? "
+            "ORDER BY bm25(search) LIMIT ?",
+            (query, limit),
+        )
+        return [(score,) + parse_doc(doc) for score, doc in rows]
@@ -0,0 +1,802 @@
+from bisect import bisect_right
+from bisect import insort
+from contextlib import contextmanager
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+
+from indexes import HotIndex
+from indexes import hot_score
+from indexes import LinkIndex
+from indexes import normalize_link
+from indexes import SortedIndex
+from indexes import UpvoteIndex
+from indexes import UsernameIndex
+from indexes import VoterIndex
+from search import comment_doc
+from search import parse_doc
+from search import SearchIndex
+
+# Comments kept ranked per post for feeds that show the best few
+TOP_COMMENTS = 10
+
+# Range of upvote counts, which are persisted as signed 64-bit ints
+MIN_UPVOTES = -(2**63)
+MAX_UPVOTES = 2**63 - 1
+
+
+def clamp_upvotes(upvotes):
+    """
+    Returns upvotes limited to the range of upvote counts
+    """
+    return min(max(upvotes, MIN_UPVOTES), MAX_UPVOTES)
+
+
+def intern(value):
+    """
+    Returns the interned copy of value if it is a string
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Record(object):
+    """
+    Base for post and comment records.
+
+    Each record carries a version that is bumped after every mutation, and
+    caches its serialized JSON bytes for the version they were built from.
+    """
+
+    __slots__ = ()
+
+    def touch(self):
+        """
+        Bumps the version after a mutation and drops the cached JSON
+        """
+        self.version += 1
+        self.cached = None
+
+    def to_json(self):
+        """
+        Returns the serialized JSON bytes, reusing the cached bytes if the
+        record has not changed since they were built
+        """
+        cached = self.cached
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        version = self.version
+        data = json.dumps(self.serialize()).encode()
+        self.cached = (version, data)
+        return data
+
+
+class Post(Record):
+    """
+    Post record. Uses __slots__ so each post stores only its field values,
+    and interns usernames so repeated names share one string.
+    """
+
+    __slots__ = (
+        "id", "upvotes", "title", "link", "username", "created", "version", "cached"
+    )
+
+    def __init__(self, id, upvotes, title, link, username, created=None):
+        """
+        Initialize post object, created now unless a unix time is given
+        """
+        self.id = id
+        self.upvotes = upvotes
+        self.title = title
+        self.link = link
+        self.username = intern(username)
+        self.created = time.time() if created is None else created
+        self.version = 0
+        self.cached = None
+
+    def serialize(self):
+        """
+        Serialize post object
+        """
+        return {
+            "id": self.id,
+            "upvotes": self.upvotes,
+            "title": self.title,
+            "link": self.link,
+            "username": self.username,
+        }
+
+
+class Comment(Record):
+    """
+    Comment record. Uses __slots__ and interned usernames like Post.
+    """
+
+    __slots__ = ("id", "upvotes", "text", "username", "version", "cached")
+
+    def __init__(self, id, upvotes, text, username):
+        """
+        Initialize comment object
+        """
+        self.id = id
+        self.upvotes = upvotes
+        self.text = text
+        self.username = intern(username)
+        self.version = 0
+        self.cached = None
+
+    def serialize(self):
+        """
+        Serialize comment object
+        """
+        return {
+            "id": self.id,
+            "upvotes": self.upvotes,
+            "text": self.text,
+            "username": self.username,
+        }
+
+
+class CommentList(dict):
+    """
+    Comments of one post keyed by id, with a version that is bumped after
+    any comment is added or edited, and a slot to cache the serialized
+    listing for that version.
+
+    The (-upvotes, id) keys of the TOP_COMMENTS best comments are kept in
+    order as comments are added, so feeds can show them without sorting,
+    and so are all the comment ids, so pages can start at a cursor without
+    scanning the comments before it.
+    """
+
+    __slots__ = ("version", "cached", "top", "ids")
+
+    def __init__(self, *args):
+        """
+        Initialize comment list
+        """
+        super().__init__(*args)
+        self.version = 0
+        self.cached = None
+        self.ids = sorted(self)
+        self.rank()
+
+    def __setitem__(self, cid, comment):
+        """
+        Adds or replaces the comment with id, cid, and updates the ranking
+        """
+        replaced = cid in self
+        super().__setitem__(cid, comment)
+        if replaced:
+            self.rank()
+            return
+        if not self.ids or self.ids[-1] < cid:
+            self.ids.append(cid)
+        else:
+            insort(self.ids, cid)
+        key = (-comment.upvotes, cid)
+        if len(self.top) < TOP_COMMENTS or key < self.top[-1]:
+            insort(self.top, key)
+            del self.top[TOP_COMMENTS:]
+
+    def rank(self):
+        """
+        Ranks all comments from scratch
+        """
+        self.top = heapq.nsmallest(
+            TOP_COMMENTS, ((-comment.upvotes, cid) for cid, comment in self.items())
+        )
+
+    def ids_after(self, cursor=None):
+        """
+        Yields the comment ids in increasing order, starting after the id,
+        cursor, which is found by bisection
+        """
+        ids = self.ids
+        i = 0 if cursor is None else bisect_right(ids, cursor)
+        while i < len(ids):
+            yield ids[i]
+            i += 1
+
+    def top_comments(self, k):
+        """
+        Returns the k comments with the most upvotes, oldest first among
+        ties. k is at most TOP_COMMENTS.
+        """
+        return [self[cid] for _, cid in self.top[:k]]
+
+    def touch(self):
+        """
+        Bumps the version after a mutation and drops the cached listing
+        """
+        self.version += 1
+        self.cached = None
+
+
+class IdAllocator(object):
+    """
+    Hands out unique, increasing integer ids across threads
+    """
+
+    def __init__(self, start=0):
+        """
+        Initializes the allocator so the next id is start
+        """
+        self.next_id = start
+        self.lock = threading.Lock()
+
+    def allocate(self, n=1):
+        """
+        Reserves a block of n consecutive ids and returns them as a range
+        """
+        with self.lock:
+            start = self.next_id
+            self.next_id += n
+        return range(start, start + n)
+
+    def next(self):
+        """
+        Returns the next id
+        """
+        return self.allocate()[0]
+
+    def advance(self, past):
+        """
+        Ensures ids handed out from now on are greater than past
+        """
+        with self.lock:
+            self.next_id = max(self.next_id, past + 1)
+
+
+class UpvoteBuffer(object):
+    """
+    Sharded counters that collect upvote deltas per post id so they can be
+    folded into the posts in one batch. Each thread adds to the shard picked
+    by its thread id, so concurrent upvotes rarely share a lock.
+    """
+
+    def __init__(self, shards=16):
+        """
+        Initializes an empty buffer with the given number of shards
+        """
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+
+    def add(self, pid, upvotes):
+        """
+        Records upvotes for the post with id, pid
+        """
+        shard = (threading.get_ident() * 2654435761 >> 16) % len(self.shards)
+        deltas, lock = self.shards[shard]
+        with lock:
+            deltas[pid] = deltas.get(pid, 0) + upvotes
+
+    def drain(self):
+        """
+        Empties the buffer and returns the summed deltas per post id
+        """
+        totals = {}
+        for deltas, lock in self.shards:
+            with lock:
+                drained = deltas.copy()
+                deltas.clear()
+            for pid, upvotes in drained.items():
+                totals[pid] = totals.get(pid, 0) + upvotes
+        return totals
+
+
+class PostStore(object):
+    """
+    Thread-safe in-memory store for posts and their comments.
+
+    Each post is guarded by one of a fixed set of striped locks chosen by
+    its id, so writes to different posts rarely contend. The shared
+    indexes are guarded by their own lock, which is only held for the
+    index update itself. Locks are always taken stripe first, then index.
+
+    Votes cast through vote() are deduplicated per user by a VoterIndex;
+    upvote_post() adds upvotes without checking who they come from.
+
+    The store has a version that is bumped after any post is created,
+    deleted or upvoted, a comment_version that is bumped after any comment
+    is added or edited, and an epoch that is unique to this process, so
+    clients can tell whether a cached feed is still current.
+
+    If upvote_staleness is set, upvotes are coalesced: they collect in an
+    UpvoteBuffer and are folded into the posts at most upvote_staleness
+    seconds later, by whichever upvote or read comes next. Until then,
+    reads see upvote counts as of the last fold. Upvotes from vote() are
+    applied at once, with their vote. close() folds what is left.
+
+    If a journal is attached, every mutation is logged to it before it is
+    applied, while the post's stripe lock is held. If an event bus is
+    attached, every mutation is published to it after it is applied.
+    """
+
+    def __init__(self, stripes=64, upvote_staleness=None):
+        """
+        Initializes an empty store with the given number of lock stripes,
+        coalescing upvotes if upvote_staleness (in seconds) is given
+        """
+        self.posts = {}
+        self.comments_lists = {}
+        self.id_index = SortedIndex()
+        self.upvote_index = UpvoteIndex()
+        self.hot_index = HotIndex()
+        self.user_posts = UsernameIndex()
+        self.user_comments = UsernameIndex()
+        self.search_index = SearchIndex()
+        self.voters = VoterIndex()
+        self.link_index = LinkIndex()
+        self.pids = IdAllocator()
+        self.cids = IdAllocator()
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+        self.index_lock = threading.Lock()
+        self.link_lock = threading.Lock()
+        self.version = 0
+        self.comment_version = 0
+        self.epoch = os.urandom(4).hex()
+        self.feed_cache = {}
+        self.upvote_staleness = upvote_staleness
+        self.upvote_buffer = None if upvote_staleness is None else UpvoteBuffer()
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.journal = None
+        self.events = None
+
+    def lock_for(self, pid):
+        """
+        Returns the stripe lock guarding the post with id, pid
+        """
+        return self.stripes[pid % len(self.stripes)]
+
+    @contextmanager
+    def frozen(self):
+        """
+        Pauses all mutations while the block runs
+        """
+        for lock in self.stripes:
+            lock.acquire()
+        self.index_lock.acquire()
+        try:
+            yield
+        finally:
+            self.index_lock.release()
+            for lock in self.stripes:
+                lock.release()
+
+    def load(self, posts, comments_lists):
+        """
+        Loads existing posts and comments, given as dicts keyed by id,
+        into the store
+        """
+        for pid, post in posts.items():
+            self.insert_post(Post(**post), CommentList({
+                cid: Comment(**comment)
+                for cid, comment in comments_lists.get(pid, {}).items()
+            }))
+            self.pids.advance(pid)
+            for cid in comments_lists.get(pid, {}):
+                self.cids.advance(cid)
+
+    def rebuild(self):
+        """
+        Rebuilds the indexes and id allocators from the posts and comments
+        dicts after they were filled in directly, e.g. during recovery
+        """
+        with self.frozen():
+            self.id_index.load(sorted(self.posts))
+            self.upvote_index.load(
+                sorted((post.upvotes, post.id) for post in self.posts.values())
+            )
+            self.hot_index.load(sorted(
+                (hot_score(post.upvotes, post.created), post.id)
+                for post in self.posts.values()
+            ))
+            self.user_posts = UsernameIndex()
+            self.user_comments = UsernameIndex()
+            self.search_index = SearchIndex()
+            self.link_index = LinkIndex()
+            all_comments = []
+            for pid in self.id_index.ascending():
+                self.user_posts.add(self.posts[pid].username, pid)
+                self.link_index.add(self.posts[pid].link, pid)
+                self.search_index.add_post(self.posts[pid])
+                for comment in self.comments_lists[pid].values():
+                    all_comments.append((comment.id, pid, comment))
+            all_comments.sort(key=lambda item: item[0])
+            for _, pid, comment in all_comments:
+                self.user_comments.add(comment.username, (pid, comment.id))
+                self.search_index.add_comment(pid, comment)
+            if self.posts:
+                self.pids.advance(max(self.posts))
+            for comments in self.comments_lists.values():
+                if comments:
+                    self.cids.advance(max(comments))
+            self.touch()
+
+    def insert_post(self, post, comments):
+        """
+        Adds post and its comments to the store and indexes
+        """
+        pid = post.id
+        with self.lock_for(pid):
+            if self.journal is not None:
+                self.journal.log_create_post(post)
+            self.posts[pid] = post
+            self.comments_lists[pid] = comments
+            with self.index_lock:
+                self.id_index.add(pid)
+                self.upvote_index.add_post(post)
+                self.hot_index.add_post(post)
+                self.user_posts.add(post.username, pid)
+                self.link_index.add(post.link, pid)
+                self.search_index.add_post(post)
+                for comment in comments.values():
+                    self.user_comments.add(comment.username, (pid, comment.id))
+                    self.search_index.add_comment(pid, comment)
+                self.touch()
+            if self.events is not None:
+                self.events.publish("post-created", pid, post.to_json())
+
+    def touch(self):
+        """
+        Bumps the store version after a post mutation and drops the cached
+        feeds. Must be called with the index lock held.
+        """
+        self.version += 1
+        self.feed_cache = {}
+
+    def cached_feed(self, key, build, version=None):
+        """
+        Returns the feed body cached under key for the given version, by
+        default the current store version, calling build() to create it if
+        it is missing or stale
+        """
+        if version is None:
+            version = self.version
+        cached = self.feed_cache.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        data = build()
+        self.feed_cache[key] = (version, data)
+        return data
+
+    def get_post(self, pid):
+        """
+        Returns the post with id, pid, or None if it does not exist
+        """
+        return self.posts.get(pid)
+
+    def create_post(self, title, link, username, unique_link=False):
+        """
+        Creates a new post and returns it. If unique_link is set, returns
+        None instead if a post with the same normalized link exists.
+        """
+        if unique_link:
+            with self.link_lock:
+                if self.posts_with_link(link):
+                    return None
+                return self.create_post(title, link, username)
+        post = Post(self.pids.next(), 1, title, link, username)
+        self.insert_post(post, CommentList())
+        return post
+
+    def create_posts(self, fields, unique_link=False):
+        """
+        Creates a post for each (title, link, username) in fields, with ids
+        allocated in one block. Returns the new posts, in the order of
+        fields. If unique_link is set, an item whose normalized link is
+        already posted, or repeats that of an earlier item, is not created
+        and gets None in its place.
+        """
+        if unique_link:
+            with self.link_lock:
+                keep = []
+                keys = set()
+                for title, link, username in fields:
+                    key = normalize_link(link) if isinstance(link, str) else None
+                    keep.append(key not in keys and not self.posts_with_link(link))
+                    if key is not None:
+                        keys.add(key)
+                created = iter(self.create_posts(
+                    [item for item, kept in zip(fields, keep) if kept]
+                ))
+                return [next(created) if kept else None for kept in keep]
+        posts = [
+            Post(pid, 1, title, link, username)
+            for pid, (title, link, username) in zip(
+                self.pids.allocate(len(fields)), fields
+            )
+        ]
+        for post in posts:
+            self.insert_post(post, CommentList())
+        return posts
+
+    def delete_post(self, pid):
+        """
+        Deletes the post with id, pid, and its comments.
+        Returns the deleted post, or None if it does not exist.
+        """
+        with self.lock_for(pid):
+            if pid not in self.posts:
+                return None
+            if self.journal is not None:
+                self.journal.log_delete_post(pid)
+            post = self.posts.pop(pid)
+            comments = self.comments_lists.pop(pid)
+            self.voters.remove_post(pid)
+            with self.index_lock:
+                self.user_posts.remove(post.username, pid)
+                self.link_index.remove(post.link, pid)
+                for comment in comments.values():
+                    self.user_comments.remove(comment.username, (pid, comment.id))
+                self.search_index.remove_post(post, comments)
+                self.id_index.remove(pid)
+                self.upvote_index.remove_post(post)
+                self.hot_index.remove_post(post)
+                self.touch()
+            if self.events is not None:
+                self.events.publish("post-deleted", pid, b'{"id": %d}' % pid)
+        return post
+
+    def upvote_post(self, pid, upvotes=1):
+        """
+        Adds upvotes to the post with id, pid.
+        Returns the post, or None if it does not exist. When upvotes are
+        coalesced, the returned post may not include these upvotes yet.
+        """
+        if self.upvote_buffer is None:
+            return self.apply_upvotes(pid, upvotes)
+        post = self.posts.get(pid)
+        if post is None:
+            return None
+        self.upvote_buffer.add(pid, upvotes)
+        self.maybe_flush_upvotes()
+        return post
+
+    def vote(self, pid, username):
+        """
+        Upvotes the post with id, pid, on behalf of username, at most once
+        per user. Returns (post, voted), where post is None if it does not
+        exist and voted is False if username had already voted on it.
+        """
+        with self.lock_for(pid):
+            post = self.posts.get(pid)
+            if post is None:
+                return None, False
+            if not self.voters.add(pid, username):
+                return post, False
+            # The vote and its upvote are logged as one record and the
+            # upvote is not coalesced, so they cannot be persisted apart
+            if self.journal is not None:
+                self.journal.log_vote(pid, username)
+            self.add_upvotes(post, 1)
+        return post, True
+
+    def apply_upvotes(self, pid, upvotes):
+        """
+        Adds upvotes directly to the post with id, pid, and its rank.
+        Returns the updated post, or None if it does not exist.
+        """
+        # Coalesced upvotes can sum past the range of a logged delta
+        upvotes = clamp_upvotes(upvotes)
+        with self.lock_for(pid):
+            post = self.posts.get(pid)
+            if post is None:
+                return None
+            if self.journal is not None:
+                self.journal.log_upvote_post(pid, upvotes)
+            self.add_upvotes(post, upvotes)
+            return post
+
+    def add_upvotes(self, post, upvotes):
+        """
+        Adds upvotes to post and its rank, without logging them. The count
+        stops at the ends of its range, as it does when the log is replayed.
+        Must be called with the lock for the post held.
+        """
+        old_upvotes = post.upvotes
+        post.upvotes = clamp_upvotes(old_upvotes + upvotes)
+        post.touch()
+        with self.index_lock:
+            self.upvote_index.update_upvotes(post, old_upvotes)
+            self.hot_index.update_upvotes(post, old_upvotes)
+            self.touch()
+        if self.events is not None:
+            self.events.publish("upvote", post.id, post.to_json())
+
+    def maybe_flush_upvotes(self):
+        """
+        Folds buffered upvotes into the posts if the last fold is older
+        than the staleness bound
+        """
+        if self.upvote_buffer is None:
+            return
+        if time.monotonic() - self.last_flush < self.upvote_staleness:
+            return
+        self.flush_upvotes()
+
+    def flush_upvotes(self, wait=False):
+        """
+        Folds all buffered upvotes into the posts. If another thread is
+        already folding, returns without waiting for it unless wait is set.
+        """
+        if not self.flush_lock.acquire(blocking=wait):
+            return
+        try:
+            self.last_flush = time.monotonic()
+            for pid, upvotes in self.upvote_buffer.drain().items():
+                self.apply_upvotes(pid, upvotes)
+        finally:
+            self.flush_lock.release()
+
+    def close(self):
+        """
+        Folds the upvotes still buffered into the posts, then closes the
+        journal, if one is attached, so no logged mutation is lost
+        """
+        if self.upvote_buffer is not None:
+            self.flush_upvotes(wait=True)
+        if self.journal is not None:
+            self.journal.close()
+
+    def publish_comment(self, event_type, pid, comment):
+        """
+        Publishes an event about comment on the post with id, pid, if an
+        event bus is attached
+        """
+        if self.events is not None:
+            data = b'{"post_id": %d, "comment": %s}' % (pid, comment.to_json())
+            self.events.publish(event_type, pid, data)
+
+    def get_comments(self, pid):
+        """
+        Returns the comments dict for the post with id, pid, or None if
+        the post does not exist
+        """
+        return self.comments_lists.get(pid)
+
+    def comment_summary(self, pid, k):
+        """
+        Returns (count, top) for the post with id, pid, where top is its k
+        comments with the most upvotes, or None if the post does not exist
+        """
+        comments = self.comments_lists.get(pid)
+        if comments is None:
+            return None
+        return len(comments), comments.top_comments(k)
+
+    def create_comment(self, pid, text, username):
+        """
+        Creates a new comment on the post with id, pid.
+        Returns the comment, or None if the post does not exist.
+        """
+        with self.lock_for(pid):
+            comments = self.comments_lists.get(pid)
+            if comments is None:
+                return None
+            comment = Comment(self.cids.next(), 1, text, username)
+            if self.journal is not None:
+                self.journal.log_create_comment(pid, comment)
+            comments[comment.id] = comment
+            comments.touch()
+            with self.index_lock:
+                self.user_comments.add(comment.username, (pid, comment.id))
+                self.search_index.add_comment(pid, comment)
+                self.comment_version += 1
+            self.publish_comment("comment-created", pid, comment)
+            return comment
+
+    def create_comments(self, pid, fields):
+        """
+        Creates a comment on the post with id, pid, for each (text, username)
+        in fields, with ids allocated in one block. Returns the new comments,
+        or None if the post does not exist.
+        """
+        with self.lock_for(pid):
+            comments = self.comments_lists.get(pid)
+            if comments is None:
+                return None
+            created = [
+                Comment(cid, 1, text, username)
+                for cid, (text, username) in zip(
+                    self.cids.allocate(len(fields)), fields
+                )
+            ]
+            for comment in created:
+                if self.journal is not None:
+                    self.journal.log_create_comment(pid, comment)
+                comments[comment.id] = comment
+            comments.touch()
+            with self.index_lock:
+                for comment in created:
+                    self.user_comments.add(comment.username, (pid, comment.id))
+                    self.search_index.add_comment(pid, comment)
+                self.comment_version += 1
+            for comment in created:
+                self.publish_comment("comment-created", pid, comment)
+            return created
+
+    def edit_comment(self, pid, cid, text):
+        """
+        Replaces the text of the comment with id, cid, on the post with
+        id, pid. Returns (comments, comment), where either is None if the
+        post or comment does not exist.
+        """
+        with self.lock_for(pid):
+            comments = self.comments_lists.get(pid)
+            if comments is None:
+                return None, None
+            comment = comments.get(cid)
+            if comment is None:
+                return comments, None
+            if self.journal is not None:
+                self.journal.log_edit_comment(pid, cid, text)
+            old_text = comment.text
+            comment.text = text
+            comment.touch()
+            comments.touch()
+            with self.index_lock:
+                self.search_index.remove(comment_doc(pid, cid), old_text)
+                self.search_index.add_comment(pid, comment)
+                self.comment_version += 1
+            self.publish_comment("comment-edited", pid, comment)
+            return comments, comment
+
+    def ids(self, after=None):
+        """
+        Yields post ids in increasing order, starting after the id, after
+        """
+        return self.id_index.ascending(after=after)
+
+    def ranked(self, reverse=False, cursor=None):
+        """
+        Yields (upvotes, id) rank keys in increasing order, or decreasing
+        if reverse is set, starting past the rank key, cursor
+        """
+        if reverse:
+            return self.upvote_index.descending(before=cursor)
+        return self.upvote_index.ascending(after=cursor)
+
+    def hot(self, cursor=None):
+        """
+        Yields (score, id) hot keys from hottest to coldest, starting past
+        the hot key, cursor
+        """
+        return self.hot_index.descending(before=cursor)
+
+    def posts_by(self, username):
+        """
+        Returns the ids of the posts created by username, in id order
+        """
+        return sorted(self.user_posts.get(username))
+
+    def posts_with_link(self, link):
+        """
+        Returns the ids of the posts whose link normalizes to the same key
+        as link, in id order
+        """
+        return sorted(self.link_index.get(link))
+
+    def comments_by(self, username):
+        """
+        Returns (pid, cid) for the comments created by username, in
+        comment id order
+        """
+        return sorted(self.user_comments.get(username), key=lambda key: key[1])
+
+    def search(self, query, limit=20):
+        """
+        Returns up to limit (score, kind, pid, cid) results for the posts
+        and comments matching query, best first. kind is "post" or
+        "comment", and cid is None for posts.
+        """
+        with self.index_lock:
+            search_index = self.search_index
+            matches = search_index.matches(query)
+        # Only the matching postings are copied under the lock; scoring
+        # them, the slow part, runs alongside writes
+        results = search_index.score(matches, limit)
+        return [(score,) + parse_doc(doc) for score, doc in results]
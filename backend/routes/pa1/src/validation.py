@@ -0,0 +1,163 @@
+"""
+Declarative request body validation.
+
+A schema is a list of Fields. compile_schema turns it into a validator
+once, at import time, precomputing each field's checks and error messages.
+Small schemas also get a closure with the checks unrolled, which accepts a
+valid body as quickly as checks written inline in the handler, leaving the
+loop over the fields to bodies that are invalid or omit optional fields.
+Validators report every invalid field, not just the first.
+"""
+import json
+
+
+# Every value a JSON decoder produces is one of these, so an untyped field
+# holds one of them unless it is missing or null
+JSON_TYPES = (str, int, float, list, dict)
+
+
+class Field(object):
+    """
+    One field of a request body schema
+    """
+
+    def __init__(self, name, type=None, required=True, default=None, label=None):
+        """
+        Initializes a field named name. If type is given, the value must be
+        an instance of it. A missing optional field takes default. label
+        names the field in error messages, and defaults to the capitalized
+        name with spaces for underscores.
+        """
+        self.name = name
+        self.type = type
+        self.required = required
+        self.default = default
+        self.label = label or name.replace("_", " ").capitalize()
+
+
+def compile_schema(*fields):
+    """
+    Compiles fields into a validator. Calling the validator with a decoded
+    request body returns (values, errors), where values is a tuple of the
+    field values in order, with defaults for missing optional fields, and
+    errors lists a message for every invalid field, empty if none are.
+    """
+    checks = []
+    for field in fields:
+        type_error = None
+        if field.type is not None:
+            type_error = "%s must be of type <%s>" % (
+                field.label, field.type.__name__
+            )
+        checks.append((
+            field.name,
+            field.type,
+            field.required,
+            field.default,
+            "%s required" % field.label,
+            type_error,
+        ))
+    missing = (None,) * len(checks)
+
+    def validate(body):
+        """
+        Returns (values, errors) for body
+        """
+        if not isinstance(body, dict):
+            return missing, ["Body must be a JSON object"]
+        get = body.get
+        values = []
+        errors = []
+        for name, field_type, required, default, required_error, type_error in checks:
+            value = get(name)
+            if value is None:
+                if required:
+                    errors.append(required_error)
+                else:
+                    value = default
+            elif field_type is not None and not isinstance(value, field_type):
+                errors.append(type_error)
+            values.append(value)
+        return tuple(values), errors
+
+    return unrolled(
+        [field.name for field in fields],
+        [field.type or JSON_TYPES for field in fields],
+        validate,
+    )
+
+
+def unrolled(names, types, validate):
+    """
+    Returns a validator that accepts a body holding every field in names
+    with a value of the matching type in types, without a loop, and hands
+    any other body to validate. Schemas with more fields than it unrolls
+    just use validate.
+    """
+    if len(names) == 1:
+        (name_0,), (type_0,) = names, types
+
+        def validate_1(body):
+            if isinstance(body, dict):
+                value_0 = body.get(name_0)
+                if isinstance(value_0, type_0):
+                    return (value_0,), []
+            return validate(body)
+
+        return validate_1
+    if len(names) == 2:
+        (name_0, name_1), (type_0, type_1) = names, types
+
+        def validate_2(body):
+            if isinstance(body, dict):
+                get = body.get
+                value_0, value_1 = get(name_0), get(name_1)
+                if isinstance(value_0, type_0) and isinstance(value_1, type_1):
+                    return (value_0, value_1), []
+            return validate(body)
+
+        return validate_2
+    if len(names) == 3:
+        (name_0, name_1, name_2), (type_0, type_1, type_2) = names, types
+
+        def validate_3(body):
+            if isinstance(body, dict):
+                get = body.get
+                value_0, value_1, value_2 = get(name_0), get(name_1), get(name_2)
+                if (
+                    isinstance(value_0, type_0)
+                    and isinstance(value_1, type_1)
+                    and isinstance(value_2, type_2)
+                ):
+                    return (value_0, value_1, value_2), []
+            return validate(body)
+
+        return validate_3
+    if len(names) == 4:
+        (name_0, name_1, name_2, name_3) = names
+        (type_0, type_1, type_2, type_3) = types
+
+        def validate_4(body):
+            if isinstance(body, dict):
+                get = body.get
+                value_0, value_1 = get(name_0), get(name_1)
+                value_2, value_3 = get(name_2), get(name_3)
+                if (
+                    isinstance(value_0, type_0)
+                    and isinstance(value_1, type_1)
+                    and isinstance(value_2, type_2)
+                    and isinstance(value_3, type_3)
+                ):
+                    return (value_0, value_1, value_2, value_3), []
+            return validate(body)
+
+        return validate_4
+    return validate
+
+
+def errors_response(errors, code=400):
+    """
+    Returns a failure response for validation errors. error holds the first
+    message, as in other failure responses, and errors holds all of them.
+    """
+    return json.dumps({"error": errors[0], "errors": errors}), code